@@ -175,7 +175,7 @@ SKIPVAL = 2500
 def run():
     skip = SKIPVAL
     while True:
-        rpc.handle(timeout=0)
+        rpc.poll()  # all pending calls, a burst is served within one tick
         # this write to oled takes non-significant
         # time which leads to poor lagged feedback,
         # hence we call this only once in a while
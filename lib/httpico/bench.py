@@ -0,0 +1,253 @@
+"""
+load test for httpico. starts the server on localhost in a process of its
+own and drives it with concurrent keep-alive clients (one process each).
+reports req/s, p50/p99 latency per kind of request and the peak RSS of the
+server, to compare performance changes against a baseline.
+
+    python bench.py --requests=5000 --concurrency=16 --mix=small:4,json:2,static,upload
+"""
+
+import os, sys, time, tempfile, subprocess
+from multiprocessing import Pool
+from socket import create_connection
+from fire import Fire
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+KINDS = ("small", "json", "static", "upload")
+
+
+def server(port, root, workers=0, filesize=16384):
+    """the server under test, run as: python bench.py server <port> <root>"""
+    sys.path.insert(0, HERE)
+    from httpico import HTTPico, fileuploader
+
+    with open(os.path.join(root, "static.txt"), "w") as f:
+        f.write(("x" * 63 + "\n") * (filesize // 64))
+    os.makedirs(os.path.join(root, "up"), exist_ok=True)
+
+    app = HTTPico("localhost", port, fbroot=root, fbroute="files/", spooldir=root)
+
+    @app.get("/small")
+    def small():
+        return "hello"
+
+    @app.get("/json")
+    def motor(id=0):
+        return {"id": id, "duty": 512, "adc": list(range(32))}
+
+    app.post("/upload")(fileuploader)
+
+    app.start(conn_queue_size=128)
+    if workers:
+        app.serve_prefork(workers)
+    else:
+        app.serve_forever()
+
+
+def uploadrequest(root):
+    """
+    the upload in capture, made whole again: the file part is cut short in
+    the capture, the filedir field and the closing boundary are appended.
+    returns a function giving the raw request for the n-th upload.
+    """
+    with open(os.path.join(HERE, "capture"), "rb") as f:
+        head, _, body = f.read().partition(b"\r\n\r\n")
+    # in case the capture lost its \r
+    head = head.replace(b"\n", b"\r\n").replace(b"\r\r\n", b"\r\n")
+    boundary = head.split(b"boundary=")[1].split(b"\r\n")[0]
+    lines = [
+        line
+        for line in head.split(b"\r\n")
+        if not line.lower().startswith(b"content-length")
+    ]
+    tail = (
+        b'\r\n--%s\r\nContent-Disposition: form-data; name="filedir"\r\n\r\n%s\r\n--%s--\r\n'
+        % (boundary, os.path.join(root, "up").encode(), boundary)
+    )
+
+    def upload(n):
+        part = body.replace(
+            b'filename="index.md"', b'filename="%d-%d.md"' % (os.getpid(), n)
+        )
+        return (
+            b"\r\n".join(lines)
+            + b"\r\nContent-Length: %d\r\n\r\n" % (len(part) + len(tail))
+            + part
+            + tail
+        )
+
+    return upload
+
+
+def request(kind, n, upload):
+    """raw request n of a kind"""
+    if kind == "upload":
+        return upload(n)
+    paths = {"small": "/small", "json": f"/json?id={n}", "static": "/files/static.txt"}
+    path = paths[kind]
+    return f"GET {path} HTTP/1.1\r\nHost: localhost\r\n\r\n".encode()
+
+
+def readresponse(sock, buf):
+    """
+    read one response off a keep-alive connection.
+    returns statuscode, whether the server closes, and what is left in buf.
+    """
+    while (end := buf.find(b"\r\n\r\n")) < 0:
+        if not (data := sock.recv(65536)):
+            raise ConnectionError("closed while reading the headers")
+        buf += data
+    head, buf = bytes(buf[:end]).decode().split("\r\n"), buf[end + 4 :]
+    statuscode = int(head[0].split()[1])
+    headers = {
+        k.lower(): v.strip() for k, _, v in (line.partition(":") for line in head[1:])
+    }
+    closes = headers.get("connection", "").lower() == "close"
+    if headers.get("transfer-encoding") == "chunked":
+        while not buf.endswith(b"0\r\n\r\n"):  # no trailers, good enough here
+            if not (data := sock.recv(65536)):
+                raise ConnectionError("closed in the middle of the body")
+            buf += data
+        return statuscode, closes, bytearray()
+    length = int(headers.get("content-length", 0)) if statuscode != 304 else 0
+    while len(buf) < length:
+        if not (data := sock.recv(65536)):
+            raise ConnectionError("closed in the middle of the body")
+        buf += data
+    return statuscode, closes, buf[length:]
+
+
+def client(args):
+    """one keep-alive client sending its share of the requests, returns kind -> latencies"""
+    port, kinds, root = args
+    upload = uploadrequest(root)
+    latencies = {kind: [] for kind in KINDS}
+    errors, sock, buf = 0, None, bytearray()
+    for n, kind in enumerate(kinds):
+        raw = request(kind, n, upload)
+        started = time.perf_counter()
+        try:
+            if sock == None:
+                sock, buf = create_connection(("localhost", port)), bytearray()
+            sock.sendall(raw)
+            statuscode, closes, buf = readresponse(sock, buf)
+        except OSError:
+            errors += 1
+            if sock != None:
+                sock.close()
+            sock = None
+            continue
+        latencies[kind].append(time.perf_counter() - started)
+        if statuscode >= 400:
+            errors += 1
+        if closes:  # e.g max_requests reached
+            sock.close()
+            sock = None
+    if sock != None:
+        sock.close()
+    return latencies, errors
+
+
+def peakrss(pid):
+    """peak resident set size of a running process in kB, None if unknown"""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] if values else 0
+
+
+def main(
+    requests=2000,
+    concurrency=8,
+    mix="small,json,static,upload",
+    workers=0,
+    filesize=16384,
+    port=8765,
+):
+    """
+    requests are split evenly over concurrency clients, in the ratio given
+    by mix (kind:weight,... of small, json, static and upload). workers > 0
+    runs the server pre-forked with that many processes.
+    """
+    weights = []
+    for item in mix.split(","):
+        kind, _, weight = item.partition(":")
+        assert kind in KINDS, f"unknown kind {kind}, one of {KINDS}"
+        weights += [kind] * int(weight or 1)
+    kinds = [weights[n % len(weights)] for n in range(requests)]
+
+    with tempfile.TemporaryDirectory() as root:
+        root += "/"  # fbroot must end with /
+        srv = subprocess.Popen(
+            [
+                sys.executable,
+                os.path.abspath(__file__),
+                "server",
+                str(port),
+                root,
+                str(workers),
+                str(filesize),
+            ]
+        )
+        try:
+            for _ in range(50):  # wait until it is listening
+                try:
+                    create_connection(("localhost", port)).close()
+                    break
+                except OSError:
+                    time.sleep(0.1)
+            shares = [(port, kinds[i::concurrency], root) for i in range(concurrency)]
+            with Pool(concurrency) as pool:
+                started = time.perf_counter()
+                results = pool.map(client, shares)
+                elapsed = time.perf_counter() - started
+            rss = peakrss(srv.pid)
+            if workers:  # the supervisor is small, the workers are what counts
+                children = subprocess.run(
+                    ["pgrep", "-P", str(srv.pid)], capture_output=True, text=True
+                )
+                rss = max(
+                    [peakrss(int(pid)) or 0 for pid in children.stdout.split()]
+                    or [rss or 0]
+                )
+        finally:
+            srv.terminate()
+            srv.wait()
+
+    latencies = {kind: [] for kind in KINDS}
+    errors = 0
+    for result, nerrors in results:
+        errors += nerrors
+        for kind, values in result.items():
+            latencies[kind] += values
+    total = sum(len(values) for values in latencies.values())
+
+    print(f"{total} requests, {concurrency} clients, {elapsed:.2f}s, {errors} errors")
+    print(f"{total / elapsed:.0f} req/s overall")
+    # the kinds are interleaved, so only their share of the requests is known,
+    # not the rate each would reach on its own
+    print(f"{'kind':<8} {'n':>7} {'share':>7} {'p50 ms':>8} {'p99 ms':>8}")
+    latencies["all"] = sum(latencies.values(), [])
+    for kind, values in latencies.items():
+        if values:
+            print(
+                f"{kind:<8} {len(values):>7} {len(values) / total * 100:>6.1f}%"
+                f" {percentile(values, 0.5) * 1000:>8.2f} {percentile(values, 0.99) * 1000:>8.2f}"
+            )
+    print(f"server peak RSS: {rss} kB" if rss != None else "server peak RSS: unknown")
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["server"]:  # the server process started by main()
+        server(int(sys.argv[2]), sys.argv[3], int(sys.argv[4]), int(sys.argv[5]))
+    else:
+        Fire(main)
@@ -1,34 +1,126 @@
-import os, sys, json, logging
+import os, sys, json, logging, time, calendar
 from socket import socket, SOCK_STREAM, AF_INET, SOL_SOCKET, SO_REUSEADDR
+from selectors import DefaultSelector, EVENT_READ, EVENT_WRITE
 from datetime import datetime as dtime
 from types import NoneType
+from binascii import crc32, b2a_base64
+from hashlib import sha1
+
+try:
+    from socket import socketpair  # wakes up the event loop from worker threads
+except ImportError:
+    socketpair = None
+
+try:
+    from socket import timeout as SocketTimeout
+except ImportError:  # micropython raises OSError(ETIMEDOUT)
+    SocketTimeout = OSError
+
+try:
+    from socket import IPPROTO_TCP, TCP_NODELAY
+except ImportError:
+    TCP_NODELAY = None
+
+try:
+    from socket import SO_REUSEPORT  # several processes listening on one port
+except ImportError:
+    SO_REUSEPORT = None
+
+try:
+    import _thread
+except ImportError:  # no threads, blocking handlers run inline
+    _thread = None
+
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:  # micropython, plain _thread workers instead
+    ThreadPoolExecutor = None
+
+try:
+    import zlib
+except ImportError:  # no zlib, responses are only sent as they are (or precompressed)
+    zlib = None
+
+getpid = getattr(os, "getpid", lambda: 0)  # a single process on micropython
+sendfile = getattr(os, "sendfile", None)  # zero-copy file -> socket, if the OS has it
+clock = getattr(time, "perf_counter", time.time)  # for timings, finer than time.time()
+
+# content types of served files, by extension
+mimetypes = {
+    ".html": "text/html; charset=UTF-8",
+    ".htm": "text/html; charset=UTF-8",
+    ".css": "text/css",
+    ".js": "application/javascript",
+    ".json": "application/json",
+    ".txt": "text/plain; charset=UTF-8",
+    ".md": "text/plain; charset=UTF-8",
+    ".csv": "text/csv",
+    ".py": "text/plain; charset=UTF-8",
+    ".png": "image/png",
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+    ".gif": "image/gif",
+    ".svg": "image/svg+xml",
+    ".ico": "image/x-icon",
+    ".pdf": "application/pdf",
+}
+
+
+class TooLarge(ValueError):
+    """a request body or form field over the in-memory limit, answered 413"""
 
 
 class Request:
-    def __init__(self):
+    maxhead = 8192  # request line and headers, longer is answered 431
+    maxbody = 65536  # bodies kept in memory (all but multipart file parts)
+
+    def __init__(self, spooldir=""):
         self.logger = logging.getLogger(__name__)
-        self.headers = {}
+        self.headers = Headers()
         self.method = None
         self.rawpath = None
         self.version = None
-        self.body = ""
+        self.body = b""
+        self.query = {}
+        self.form = {}
+        self.keepalive = False  # set by the server, adds "Connection: keep-alive"
+        self.sse = None  # set by the server for event stream subscriptions
+        self.ws = None  # websocket handler, set by the server for upgrades
+        self.spooldir = spooldir  # where uploaded files are streamed to
+        self.remaining = 0  # body bytes still to be fed
+        self.multipart = None  # streaming parser for multipart/form-data bodies
+        self.started = None  # clock() when the headers were complete, for metrics
+        self.label = None  # route it is counted under in the metrics, set by the server
+        # (route, pathparams, fields, cachekey, mtimes) of a blocking handler
+        self.deferred = None
 
     def __call__(self, rawhttp):
-        if "\r\n\r\n" in rawhttp:
-            header_end = rawhttp.index("\r\n\r\n")  # first index of "\r\n\r\n"
-        else:
+        """
+        parse the request line and headers. the body (if any) is then
+        passed in incrementally through feed(), whatever part of it
+        follows the headers in rawhttp is fed right away.
+
+        rawhttp is bytes, only the request line is decoded here, header
+        values are decoded lazily when looked up and the body stays bytes.
+        """
+        if type(rawhttp) is str:
+            rawhttp = rawhttp.encode()
+        header_end = rawhttp.find(b"\r\n\r\n")  # first index of "\r\n\r\n"
+        if header_end < 0:
             return
-        head, self.body = rawhttp[:header_end], rawhttp[header_end + 4 :]
-        head = head.split("\r\n")
-        self.method, self.rawpath, self.version = head.pop(0).strip().split(" ")
-        self.headers = {}
-        for h in head:
-            first_colon_index = h.index(":")
-            key, val = h[:first_colon_index], h[first_colon_index + 1 :].strip()
-            self.headers[key] = val
-        
-        del head # strings are immutable in python, so we free up the space after extraction.
-        
+        self.query = {}
+        self.form = {}
+        self.body = b""
+        if (line_end := rawhttp.find(b"\r\n", 0, header_end)) < 0:
+            line_end = header_end  # no headers at all
+        self.method, self.rawpath, version = (
+            bytes(rawhttp[:line_end]).decode().strip().split(" ")
+        )
+        if version not in ("HTTP/1.0", "HTTP/1.1"):  # answered 400 (as HTTP/1.1)
+            raise ValueError(f"unsupported HTTP version: {version}")
+        self.version = version
+        self.headers = Headers(rawhttp, line_end + 2, header_end)
+
         # url_decode the rawpath as it must have url_encoded any special character.
         self.rawpath = self.url_decode(self.rawpath)
 
@@ -37,7 +129,6 @@ class Request:
         if len(route) > 1:  # check if we have get params
             get_params = route[1]
             # parse GET params
-            self.query = {}
             try:
                 for q in get_params.split("&"):
                     qkey, qval = q.split("=")
@@ -48,131 +139,1125 @@ class Request:
                 )
         self.route = route[0]
 
-        # extract paramters/data from POST
-        if self.method == "POST" and (int(self.headers["Content-Length"]) > 0):
-            # variables to be expected when handling a POST request.
-            self.form = {}
+        # prepare for the body
+        self.remaining = int(self.headers.get("Content-Length", 0))
+        if self.remaining < 0:
+            raise ValueError(f"negative Content-Length: {self.remaining}")
+        self._body = bytearray()
+        conttype = self.headers.get("Content-Type", "")
+        if "multipart/form-data" in conttype:
+            # check if has boundaries
+            boundary = None
+            for cnt in conttype.split(";"):
+                if "boundary" in cnt:
+                    boundary = cnt.split("=")[1].strip()
+            if boundary != None:
+                self.multipart = MultipartParser(boundary, self.form, self.spooldir)
+        if self.multipart == None and self.remaining > self.maxbody:
+            raise TooLarge(f"Content-Length {self.remaining} over {self.maxbody}")
+
+        if len(rawhttp) > header_end + 4:
+            with memoryview(rawhttp) as mv:
+                self.feed(mv[header_end + 4 :])
+
+    def feed(self, data):
+        """
+        consume the next piece of the body, returns the no. of bytes used
+        (never more than what is still expected as per Content-Length).
+        """
+        used = min(len(data), self.remaining)
+        if used == 0:
+            return 0
+        data = data[:used]
+        self.remaining -= used
+        if self.multipart != None:
+            self.multipart.feed(data)  # file parts go to disk as they arrive
+        else:
+            self._body += data
+
+        if self.remaining == 0:
+            self._finish()
+        return used
 
-            if (
-                self.headers["Content-Type"] == "application/x-www-form-urlencoded"
-            ) and (int(self.headers["Content-Length"].split(":")) > 0):
-                # parse FROM params
-                for q in self.body.split("&"):
-                    qkey, qval = q.split("=")
-                    self.form[qkey] = qval
-
-            elif "multipart/form-data" in (conttype := self.headers["Content-Type"]):
-                # check if has boundaries
-                boundary = None
-                cnts = conttype.split(f";")
-                for cnt in cnts:
-                    if "boundary" in cnt:
-                        boundary = cnt.split("=")[1]
-                
-                if boundary != None:
-                    end_boundary_removed_body = self.body.split(f"--{boundary}--")[0]
-                    dataparts = end_boundary_removed_body.split(f"--{boundary}\r\n")
-                    for datapt in dataparts:
-                        if not "\r\n\r\n" in datapt:
-                            continue
-                        __headers, payload = datapt.split("\r\n\r\n")  # headers and
-                        #payload = payload[
-                        #    :-2
-                        #]  # the last two bytes are \r\n and are not part of the payload
-                        for head in __headers.split("\r\n"):
-                            if head.startswith("Content-Disposition:"):
-                                cdispositions = head[len("Content-Disposition:") :]
-                                if "form-data" in cdispositions:
-                                    # Content-Disposition: form-data; name="filedir"
-                                    for cdisp_part in cdispositions.split(";"):
-                                        if (
-                                            "name=" in cdisp_part
-                                        ):  # this handles both name=.. and filename=... | a problem with this is if someone is sending a variable named "filename" itself bnut we let it be for now.
-                                            if "filename=" in cdisp_part:
-                                                filename = cdisp_part.split("=")[
-                                                    -1
-                                                ]  # has surrounding double quotes
-                                                filename = filename[
-                                                    1:-1
-                                                ]  # remove the double quotes filename
-                                                self.form["filename"] = filename
-                                            else:
-                                                varname = cdisp_part.split("=")[
-                                                    1
-                                                ]  # varname = '"variable_name"'
-                                                varname = varname[
-                                                    1:-1
-                                                ]  # varname = 'variable_name'
-                                                self.form[varname] = payload
+    def _finish(self):
+        if self.multipart != None:
+            self.multipart.close()
+            return
+
+        self.body = bytes(self._body)  # raw bytes, binary safe
+        self._body = bytearray()
+        # extract paramters/data from url-encoded forms
+        if self.headers.get("Content-Type") == "application/x-www-form-urlencoded":
+            for q in self.body.split(b"&"):
+                qkey, _, qval = q.partition(b"=")
+                self.form[self.url_decode(qkey.decode())] = self.url_decode(
+                    qval.decode()
+                )
+
+    def cleanup(self):
+        """remove spooled uploads which the handler did not move into place"""
+        if self.multipart != None:
+            self.multipart.close()
+        for val in self.form.values():
+            if type(val) is UploadedFile:
+                val.discard()
+
+    def wants_keepalive(self):
+        """HTTP/1.1 is persistent unless told otherwise, HTTP/1.0 only on request"""
+        connhdr = self.headers.get("Connection", "").lower()
+        if self.version == "HTTP/1.1":
+            return connhdr != "close"
+        return connhdr == "keep-alive"
 
     def url_decode(self, url):
-        # this function was generated by chatgpt
+        if "%" not in url and "+" not in url:
+            return url  # nothing encoded, no copy
+        url = url.replace("+", " ")  # Decode '+' as space
+        parts = url.split("%")
+        # percent-encoded characters are utf-8 bytes, collect them before decoding
+        decoded = bytearray(parts[0].encode())
+        for part in parts[1:]:
+            decoded.append(int(part[:2], 16))  # the two hex characters
+            decoded += part[2:].encode()
+        return decoded.decode()
+
+
+class Headers:
+    """
+    request headers, kept as the raw bytes of the header block.
+    a value is only located and decoded when it is looked up
+    (case-insensitive), most headers a browser sends are never used.
+    """
+
+    def __init__(self, raw=b"", start=0, end=0):
+        self.raw = raw
+        self.start = start  # header block is raw[start:end]
+        self.end = end
+        self.cache = {}  # lowercased key -> decoded value
+
+    def get(self, key, default=None):
+        lkey = key.lower()
+        if lkey in self.cache:
+            return self.cache[lkey]
+        needle = lkey.encode()
+        raw, pos = self.raw, self.start
+        while pos < self.end:
+            if (eol := raw.find(b"\r\n", pos, self.end)) < 0:
+                eol = self.end
+            colon = raw.find(b":", pos, eol)
+            # only same length keys are sliced out and compared
+            if colon - pos == len(needle) and raw[pos:colon].lower() == needle:
+                val = bytes(raw[colon + 1 : eol]).strip().decode()
+                self.cache[lkey] = val
+                return val
+            pos = eol + 2
+        return default
+
+    def __getitem__(self, key):
+        if (val := self.get(key)) is None:
+            raise KeyError(key)
+        return val
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def items(self):
+        for line in bytes(self.raw[self.start : self.end]).split(b"\r\n"):
+            key, _, val = line.partition(b":")
+            yield key.decode(), val.strip().decode()
+
+
+class UploadedFile:
+    """a file part of a multipart/form-data body, spooled to disk"""
+
+    def __init__(self, path, filename):
+        # spool file, move it into place or it is removed after the request
+        self.path = path
+        self.filename = filename
+        self.size = 0
+
+    def moveto(self, fspath):
+        try:
+            os.rename(self.path, fspath)
+        except OSError:  # spool on another filesystem, copy it over
+            with open(self.path, "rb") as f, open(fspath, "wb") as g:
+                while chunk := f.read(2048):
+                    g.write(chunk)
+            os.remove(self.path)
+        self.path = None
+
+    def discard(self):
+        if self.path != None and os.path.exists(self.path):
+            os.remove(self.path)
+        self.path = None
+
+
+class MultipartParser:
+    """
+    incremental multipart/form-data parser. boundaries are searched as the
+    data arrives, file parts are written straight into spool files and
+    only the plain form fields are kept in memory.
+    """
+
+    spoolcount = 0  # for unique spool file names
+
+    def __init__(self, boundary, form, spooldir=""):
+        self.delim = f"\r\n--{boundary}".encode()
+        self.form = form
+        self.spooldir = spooldir
+        # so that the first boundary looks like the others
+        self.buf = bytearray(b"\r\n")
+        # preamble -> next -> headers -> data -> next ... -> end
+        self.state = "preamble"
+        self.sink = None  # open spool file or bytearray of the current part
+        self.inmemory = 0  # bytes of plain fields kept, bounded by Request.maxbody
+        self.upload = None  # UploadedFile of the current part, None for plain fields
+        self.name = None  # form field name of the current part
+
+    def feed(self, data):
+        self.buf += data
+        buf, delim = self.buf, self.delim
+        while True:
+            if self.state in ("preamble", "data"):
+                idx = buf.find(delim)
+                if idx < 0:
+                    # keep a tail which could be the start of a split boundary
+                    safe = len(buf) - len(delim) + 1
+                    if safe > 0:
+                        if self.state == "data":
+                            self._write(buf[:safe])
+                        del buf[:safe]
+                    return
+                if self.state == "data":
+                    self._write(buf[:idx])
+                    self._endpart()
+                del buf[: idx + len(delim)]
+                self.state = "next"
+
+            elif self.state == "next":
+                if len(buf) < 2:
+                    return
+                if buf[:2] == b"--":  # closing boundary
+                    self.state = "end"
+                    continue
+                del buf[:2]  # \r\n after the boundary
+                self.state = "headers"
+
+            elif self.state == "headers":
+                idx = buf.find(b"\r\n\r\n")
+                if idx < 0:
+                    if len(buf) > Request.maxbody:
+                        raise TooLarge("multipart part headers too long")
+                    return
+                self._startpart(bytes(buf[:idx]).decode())
+                del buf[: idx + 4]
+                self.state = "data"
+
+            else:  # end, ignore the epilogue
+                buf[:] = b""
+                return
+
+    def _startpart(self, headers):
+        self.name, filename = None, None
+        for head in headers.split("\r\n"):
+            if head.startswith("Content-Disposition:"):
+                # Content-Disposition: form-data; name="filecontent"; filename="index.md"
+                for cdisp_part in head[len("Content-Disposition:") :].split(";"):
+                    key, _, val = cdisp_part.strip().partition("=")
+                    if key == "name":
+                        self.name = val[1:-1]  # remove the double quotes
+                    elif key == "filename":
+                        filename = val[1:-1]
+
+        if filename != None:
+            self.form["filename"] = filename
+            MultipartParser.spoolcount += 1
+            # forked workers share spooldir and start from the same count
+            spoolpath = os.path.join(
+                self.spooldir,
+                f".httpico-upload-{getpid()}-{MultipartParser.spoolcount}",
+            )
+            self.upload = UploadedFile(spoolpath, filename)
+            self.sink = open(spoolpath, "xb")  # never truncate another upload
+        else:
+            self.upload = None
+            self.sink = bytearray()
+
+    def _write(self, data):
+        if self.upload != None:
+            self.upload.size += self.sink.write(data)
+        else:
+            self.inmemory += len(data)
+            if self.inmemory > Request.maxbody:
+                raise TooLarge(f"form fields over {Request.maxbody} bytes")
+            self.sink += data
+
+    def _endpart(self):
+        if self.upload != None:
+            self.sink.close()
+            val = self.upload
+        else:
+            val = bytes(self.sink).decode()
+        if self.name != None:
+            self.form[self.name] = val
+        elif self.upload != None:
+            self.upload.discard()
+        self.sink, self.upload = None, None
+
+    def close(self):
+        if self.sink != None:  # truncated body, drop the unfinished part
+            if self.upload != None:
+                self.sink.close()
+                self.upload.discard()
+            self.sink, self.upload = None, None
+
+
+class Route:
+    """a registered handler, compiled once when it is registered"""
+
+    statuscodes = {"POST": 201}  # default status code per method, else 200
+
+    def __init__(self, method, path, cb):
+        self.method = method
+        self.path = path
+        self.cb = cb
+        self.statuscode = self.statuscodes.get(method, 200)
+        self.cachettl = None  # seconds responses are cached for, see HTTPico.route()
+        self.deps = ()  # files the cached responses are built from
+        self.blocking = False  # run on the worker pool, off the I/O loop
+        # names of the handler arguments, bound methods skip self
+        code = cb.__code__
+        skip = 1 if hasattr(cb, "__self__") else 0
+        self.argnames = code.co_varnames[skip : code.co_argcount]
+        # path parameters: segment index -> name, for /motor/{id}
+        self.segments = path.split("/")
+        self.params = {
+            i: seg[1:-1]
+            for i, seg in enumerate(self.segments)
+            if seg.startswith("{") and seg.endswith("}")
+        }
+
+    def match(self, segments):
+        """path parameters if the split request path matches, else None"""
+        pathparams = {}
+        for i, seg in enumerate(self.segments):
+            if i in self.params:
+                pathparams[self.params[i]] = segments[i]
+            elif seg != segments[i]:
+                return None
+        return pathparams
+
+    def __call__(self, pathparams, fields):
+        kwargs = {}
+        for arg in self.argnames:
+            kwargs[arg] = pathparams[arg] if arg in pathparams else fields.get(arg)
+        return self.cb(**kwargs)
+
+
+class Router:
+    """
+    per method route tables. plain paths are a single dict lookup,
+    paths with parameters are grouped by their no. of segments.
+    """
+
+    def __init__(self):
+        self.static = {}  # method -> {path: Route}
+        self.dynamic = {}  # method -> {no. of segments: [Route, ...]}
+
+    def add(self, method, path, cb):
+        route = Route(method, path, cb)
+        if route.params:
+            bylen = self.dynamic.setdefault(method, {})
+            bylen.setdefault(len(route.segments), []).append(route)
+        else:
+            self.static.setdefault(method, {})[path] = route
+        return route
+
+    def find(self, method, path):
+        """(Route, path parameters) for the request, None if not registered"""
+        if (route := self.static.get(method, {}).get(path)) != None:
+            return route, {}
+        if method in self.dynamic:
+            segments = path.split("/")
+            for route in self.dynamic[method].get(len(segments), ()):
+                if (pathparams := route.match(segments)) != None:
+                    return route, pathparams
+        return None
+
+
+class ResponseCache:
+    """
+    encoded responses of GET routes registered with a cache_ttl. least
+    recently used entries are dropped first to stay within maxbytes. an
+    entry expires after its ttl, or as soon as one of the files it was
+    built from (deps) has a new mtime.
+    """
+
+    def __init__(self, maxbytes=65536):
+        # key -> (resp, expires, deps, mtimes), least recently used first
+        self.entries = {}
+        self.maxbytes = maxbytes
+        self.nbytes = 0  # total size of the cached responses
+
+    @staticmethod
+    def mtimes(deps):
+        try:
+            return tuple(os.stat(dep).st_mtime for dep in deps)
+        except OSError:  # a missing file, compares as changed once it exists
+            return None
+
+    def get(self, key):
+        """the cached response for key, None if there is none or it is stale"""
+        if (entry := self.entries.pop(key, None)) == None:
+            return None
+        resp, expires, deps, mtimes = entry
+        if time.time() >= expires or (deps and self.mtimes(deps) != mtimes):
+            self.nbytes -= len(resp)
+            return None
+        self.entries[key] = entry  # reinserted, now the most recently used
+        return resp
+
+    def put(self, key, resp, ttl, deps=(), mtimes=None):
+        """cache resp under key for ttl seconds, mtimes are the deps' before it was built"""
+        if len(resp) > self.maxbytes:
+            return
+        if (old := self.entries.pop(key, None)) != None:
+            self.nbytes -= len(old[0])
+        while self.nbytes + len(resp) > self.maxbytes:
+            self.nbytes -= len(self.entries.pop(next(iter(self.entries)))[0])
+        self.entries[key] = resp, time.time() + ttl, deps, mtimes
+        self.nbytes += len(resp)
+
+
+def httpdate(timestamp):
+    """format a unix timestamp as an HTTP date, e.g for Last-Modified"""
+    return time.strftime("%a, %d %b %Y %H:%M:%S GMT", time.gmtime(timestamp))
+
+
+def notmodified(headers, etag, mtime):
+    """whether the conditional request headers say the client copy is current"""
+    if (inm := headers.get("If-None-Match")) != None:  # takes precedence
+        return inm.strip() == "*" or etag in [t.strip() for t in inm.split(",")]
+    if (ims := headers.get("If-Modified-Since")) != None:
+        try:
+            since = dtime.strptime(ims, "%a, %d %b %Y %H:%M:%S GMT")
+        except ValueError:
+            return False
+        return mtime <= calendar.timegm(since.timetuple())
+    return False
+
+
+def scandir(path):
+    """(name, isdir, size, mtime) of every entry in path, in one pass"""
+    entries = []
+    if hasattr(os, "scandir"):
+        with os.scandir(path) as it:
+            for entry in it:
+                try:
+                    st = entry.stat()
+                except OSError:  # vanished while listing
+                    continue
+                entries.append((entry.name, entry.is_dir(), st.st_size, st.st_mtime))
+    else:
+        for name in os.listdir(path):
+            st = os.stat(os.path.join(path, name))
+            entries.append((name, st[0] & 0x4000 != 0, st[6], st[8]))  # S_IFDIR
+    return entries
+
+
+def restat(path, names):
+    """(name, isdir, size, mtime) of the entries (name, isdir) known to be in path"""
+    entries = []
+    for name, isdir in names:
+        try:
+            st = os.stat(os.path.join(path, name))
+        except OSError:  # vanished since
+            continue
+        # st_mtime is a float on CPython, micropython only has the tuple
+        entries.append((name, isdir, st[6], getattr(st, "st_mtime", st[8])))
+    return entries
+
+
+def tobytes(chunks):
+    """bytes from what a streaming handler yields (bytes, str, dict or else)"""
+    for chunk in chunks:
+        if type(chunk) is dict:
+            yield json.dumps(chunk).encode()
+        elif type(chunk) is str:
+            yield chunk.encode()
+        elif type(chunk) in (bytes, bytearray, memoryview):
+            yield chunk
+        else:
+            yield str(chunk).encode()
+
+
+def acceptsencoding(headers, coding):
+    """whether the Accept-Encoding request header allows coding (gzip/deflate)"""
+    accepted = False
+    for token in headers.get("Accept-Encoding", "").split(","):
+        name, _, params = token.partition(";")
+        name, q = name.strip().lower(), params.strip()
+        if name in (coding, "*"):
+            accepted = not q.startswith("q=") or q[2:].strip("0. ") != ""  # q=0 refuses
+            if name == coding:  # named explicitly, wins over *
+                break
+    return accepted
+
+
+def compressible(conttype):
+    """whether a content type is worth compressing (text, not images/archives)"""
+    return conttype.startswith("text/") or conttype.split(";")[0] in (
+        "application/json",
+        "application/javascript",
+        "image/svg+xml",
+    )
+
+
+def compress(body, encoding, level=6):
+    """gzip or deflate (zlib format) body in one go"""
+    z = zlib.compressobj(level, zlib.DEFLATED, 31 if encoding == "gzip" else 15)
+    return z.compress(body) + z.flush()
+
+
+def compresschunks(chunks, encoding, flush=False, level=6):
+    """
+    gzip or deflate a generator of bytes as it goes. with flush every chunk
+    is pushed out right away (live streams), otherwise zlib buffers as it
+    likes for a better ratio.
+    """
+    z = zlib.compressobj(level, zlib.DEFLATED, 31 if encoding == "gzip" else 15)
+    try:
+        for chunk in chunks:
+            out = z.compress(chunk)
+            if flush:
+                out += z.flush(zlib.Z_SYNC_FLUSH)
+            if out:
+                yield out
+        yield z.flush()
+    finally:
+        if hasattr(chunks, "close"):  # e.g. a FileBody, when the client left early
+            chunks.close()
+
+
+def chunkedencode(chunks):
+    """frame a generator of bytes for Transfer-Encoding: chunked"""
+    for chunk in chunks:
+        if len(chunk):  # an empty chunk would end the body
+            yield b"%x\r\n" % len(chunk) + chunk + b"\r\n"
+    yield b"0\r\n\r\n"
+
+
+def parseranges(rangehdr, size, maxranges=16):
+    """
+    byte ranges [(start, end), ...] (end inclusive) asked for by a
+    "Range: bytes=0-99,200-,-50" header on a file of size bytes.
+    returns [] if none are satisfiable and None if the header is to be
+    ignored (malformed, not bytes, or too many ranges).
+    """
+    unit, _, specs = rangehdr.partition("=")
+    if unit.strip() != "bytes":
+        return None
+    ranges = []
+    try:
+        for spec in specs.split(","):
+            first, _, last = spec.strip().partition("-")
+            if first == "":  # suffix range, the last n bytes
+                if int(last) > 0 and size > 0:
+                    ranges.append((max(0, size - int(last)), size - 1))
+            elif int(first) < size:
+                end = size - 1 if last == "" else min(int(last), size - 1)
+                if end < int(first):
+                    return None
+                ranges.append((int(first), end))
+    except ValueError:
+        return None
+    return ranges if len(ranges) <= maxranges else None
+
+
+class FileBody:
+    """
+    body of a served file. sent with sendfile() where the OS has it,
+    otherwise read chunk by chunk into one reusable buffer, so streaming
+    a large file does not allocate per chunk.
+    """
+
+    def __init__(self, path, offset=0, length=None, chunksize=2048):
+        self.f = open(path, "rb")
+        self.offset = offset
+        self.remaining = os.stat(path).st_size - offset if length == None else length
+        self.chunksize = chunksize
+        self.buf = None
+
+    def sendfile(self, sock):
+        """send the next piece straight from the file, returns 0 when done"""
+        if self.remaining <= 0:
+            self.close()
+            return 0
+        sent = sendfile(sock.fileno(), self.f.fileno(), self.offset, self.remaining)
+        if sent == 0:  # file shrunk underneath us
+            self.remaining = 0
+        self.offset += sent
+        self.remaining -= sent
+        return sent
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.remaining <= 0:
+            self.close()
+            raise StopIteration
+        if self.buf == None:
+            self.buf = bytearray(min(self.chunksize, self.remaining))
+            self.f.seek(self.offset)
+        mv = memoryview(self.buf)
+        nread = self.f.readinto(mv[: min(len(self.buf), self.remaining)])
+        if not nread:
+            self.close()
+            raise StopIteration
+        self.offset += nread
+        self.remaining -= nread
+        return mv[:nread]  # only valid until the next chunk is read
+
+    def close(self):
+        self.remaining = 0
+        self.f.close()
+
+
+class EventStream:
+    """a server-sent events producer and the connections subscribed to it"""
+
+    def __init__(self, producer, interval=1, event=None):
+        self.producer = producer
+        self.interval = interval
+        self.event = event  # "event:" field of every update, if any
+        self.subscribers = set()  # Connections
+        self.nexttick = 0
+        self.lastdata = None
+        self.lastframe = None  # latest update, encoded once for all subscribers
+        self.lastchunk = None  # the same, framed for Transfer-Encoding: chunked
+
+    def encode(self, data):
+        if type(data) is not str:
+            data = json.dumps(data)
+        frame = "" if self.event == None else f"event: {self.event}\n"
+        for line in data.split("\n"):
+            frame += f"data: {line}\n"
+        self.lastframe = (frame + "\n").encode()
+        self.lastchunk = None
+
+    def frame(self, chunked):
+        """the latest update as sent on the wire"""
+        if not chunked:
+            return self.lastframe
+        if self.lastchunk == None:
+            self.lastchunk = b"%x\r\n%s\r\n" % (len(self.lastframe), self.lastframe)
+        return self.lastchunk
+
+
+class WebSocket:
+    """
+    server side of an RFC 6455 websocket, created by the upgrade handshake.
+    frames are decoded as data arrives, complete messages (str for text,
+    bytes for binary) are passed to handler(ws, msg), whose return value
+    (if not None) is sent back. pings are answered with pongs.
+    """
+
+    GUID = b"258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+    maxmsgsize = 65536  # bigger messages close the connection (1009)
+
+    def __init__(self, handler, notify=None):
+        self.handler = handler
+        self.notify = notify  # called when frames have been queued for sending
+        self.buf = bytearray()
+        self.fragments = bytearray()  # payload of a fragmented message so far
+        self.fragopcode = 0
+        self.outq = []  # encoded frames waiting to be sent
+        self.closing = False  # close frame sent, the connection ends after it
+        self.logger = logging.getLogger(__name__)
+
+    @classmethod
+    def accept(cls, key):
+        """Sec-WebSocket-Accept value for the client's Sec-WebSocket-Key"""
+        return b2a_base64(sha1(key.encode() + cls.GUID).digest()).strip().decode()
+
+    def send(self, msg, opcode=None):
+        """queue a message: str/dict as text, bytes as binary"""
+        if self.closing:
+            return
+        if type(msg) is dict:
+            msg = json.dumps(msg)
+        if type(msg) is str:
+            msg, opcode = msg.encode(), opcode or 0x1
+        self.outq.append(self.frame(opcode or 0x2, msg))
+        if self.notify != None:
+            self.notify()
+
+    def close(self, code=1000):
+        if not self.closing:
+            self.outq.append(self.frame(0x8, code.to_bytes(2, "big")))
+            self.closing = True  # before notify, the connection ends once it is sent
+            if self.notify != None:
+                self.notify()
+
+    @staticmethod
+    def frame(opcode, payload):
+        """an unmasked, unfragmented frame, as sent by servers"""
+        n = len(payload)
+        if n < 126:
+            head = bytes((0x80 | opcode, n))
+        elif n < 65536:
+            head = bytes((0x80 | opcode, 126)) + n.to_bytes(2, "big")
+        else:
+            head = bytes((0x80 | opcode, 127)) + n.to_bytes(8, "big")
+        return head + payload
+
+    def feed(self, data):
+        """decode the frames in data (may be partial) and dispatch them"""
+        self.buf += data
+        buf = self.buf
+        while len(buf) >= 2 and not self.closing:
+            fin, opcode = buf[0] & 0x80, buf[0] & 0x0F
+            masked, n = buf[1] & 0x80, buf[1] & 0x7F
+            pos = 2
+            if n == 126:
+                if len(buf) < 4:
+                    return
+                n, pos = int.from_bytes(buf[2:4], "big"), 4
+            elif n == 127:
+                if len(buf) < 10:
+                    return
+                n, pos = int.from_bytes(buf[2:10], "big"), 10
+            # clients must mask, no extensions (RSV bits)
+            if not masked or buf[0] & 0x70:
+                self.close(1002)
+                return
+            # control frames are short and whole
+            if opcode & 0x8 and (n > 125 or not fin):
+                self.close(1002)
+                return
+            if n + len(self.fragments) > self.maxmsgsize:
+                self.close(1009)
+                return
+            if len(buf) < pos + 4 + n:
+                return  # wait for the rest of the frame
+            mask = buf[pos : pos + 4]
+            payload = buf[pos + 4 : pos + 4 + n]
+            del buf[: pos + 4 + n]
+            if n:  # unmask the whole payload as one big integer xor
+                key = (bytes(mask) * (n // 4 + 1))[:n]
+                payload = (
+                    int.from_bytes(payload, "big") ^ int.from_bytes(key, "big")
+                ).to_bytes(n, "big")
+            self.dispatch(fin, opcode, bytes(payload))
+
+    def dispatch(self, fin, opcode, payload):
+        if opcode == 0x8:  # close, answer it and hang up
+            self.close(
+                int.from_bytes(payload[:2], "big") if len(payload) >= 2 else 1000
+            )
+            return
+        if opcode == 0x9:  # ping
+            self.send(payload, opcode=0xA)
+            return
+        if opcode == 0xA:  # pong
+            return
+        if opcode != 0x0:  # first frame of a message
+            self.fragopcode = opcode
+        self.fragments += payload
+        if not fin:
+            return  # more fragments to come
+        msg, self.fragments = bytes(self.fragments), bytearray()
+        try:
+            if self.fragopcode == 0x1:
+                msg = msg.decode()
+            if (reply := self.handler(self, msg)) != None:
+                self.send(reply)
+        except UnicodeError:  # text which is not UTF-8
+            self.close(1007)
+        except Exception as e:
+            self.logger.info(f"Exception in websocket handler: {e}")
+            self.close(1011)
+
+
+class WorkerPool:
+    """
+    runs blocking handlers on at most nworkers threads, off the I/O loop.
+    concurrent.futures where available, else _thread threads which keep
+    taking queued jobs until there are none left. done(result, error) is
+    called in the worker thread when a job is over.
+    """
+
+    def __init__(self, nworkers=4):
+        self.nworkers = nworkers
+        self.executor = (
+            ThreadPoolExecutor(nworkers) if ThreadPoolExecutor != None else None
+        )
+        self.lock = _thread.allocate_lock()
+        self.backlog = []  # jobs waiting for a free _thread worker
+        self.running = 0  # busy _thread workers
+
+    def submit(self, fn, args, done):
+        job = fn, args, done
+        if self.executor != None:
+            self.executor.submit(self.run, job)
+            return
+        with self.lock:
+            if self.running >= self.nworkers:
+                self.backlog.append(job)
+                return
+            self.running += 1
+        _thread.start_new_thread(self.work, (job,))
+
+    @staticmethod
+    def run(job):
+        fn, args, done = job
+        try:
+            result, error = fn(*args), None
+        except Exception as e:
+            result, error = None, e
+        done(result, error)
+
+    def work(self, job):
+        while job != None:
+            self.run(job)
+            with self.lock:
+                job = self.backlog.pop(0) if self.backlog else None
+                if job == None:
+                    self.running -= 1
+
+    def shutdown(self):
+        """drop the jobs not started yet, running ones finish on their own"""
+        if self.executor != None:
+            try:
+                self.executor.shutdown(wait=False, cancel_futures=True)
+            except TypeError:  # python < 3.9
+                self.executor.shutdown(wait=False)
+        with self.lock:
+            self.backlog = []
+
+
+class Metrics:
+    """
+    low overhead counters and latency histograms with fixed buckets (in
+    seconds), rendered in the prometheus text format. a histogram is a
+    list of sample counts per bucket, the count above the last bucket and
+    the sum of all samples.
+    """
+
+    buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+    phases = ("parse", "handler", "send")
+
+    def __init__(self):
+        self.statuses = {}  # statuscode -> no. of responses
+        self.bytesin = 0
+        self.bytesout = 0
+        self.phasetimes = {phase: self.histogram() for phase in self.phases}
+        self.routes = {}  # route -> histogram of the request latency
+
+    def histogram(self):
+        return [0] * (len(self.buckets) + 1) + [0.0]
+
+    def observe(self, hist, seconds):
         i = 0
-        decoded = ""
-        while i < len(url):
-            if url[i] == "%":  # Check for percent-encoded character
-                hex_value = url[i + 1 : i + 3]  # Get the next two characters
-                decoded += chr(int(hex_value, 16))  # Convert hex to ASCII
-                i += 3  # Move past the percent and two hex characters
-            elif url[i] == "+":  # Decode '+' as space
-                decoded += " "
-                i += 1
-            else:
-                decoded += url[i]  # Add regular character
-                i += 1
-        return decoded
+        for le in self.buckets:
+            if seconds <= le:
+                break
+            i += 1
+        hist[i] += 1
+        hist[-1] += seconds
+
+    def phase(self, phase, seconds):
+        """time spent parsing/in the handler/sending"""
+        self.observe(self.phasetimes[phase], seconds)
+
+    def request(self, route, seconds):
+        """latency of a request, from complete headers to the last byte sent"""
+        if (hist := self.routes.get(route)) == None:
+            hist = self.routes[route] = self.histogram()
+        self.observe(hist, seconds)
+
+    def status(self, statuscode):
+        self.statuses[statuscode] = self.statuses.get(statuscode, 0) + 1
+
+    def render(self):
+        """everything in the prometheus text exposition format"""
+        lines = ["# TYPE httpico_responses_total counter"]
+        for code, n in sorted(self.statuses.items()):
+            lines.append(f'httpico_responses_total{{code="{code}"}} {n}')
+        lines.append("# TYPE httpico_received_bytes_total counter")
+        lines.append(f"httpico_received_bytes_total {self.bytesin}")
+        lines.append("# TYPE httpico_sent_bytes_total counter")
+        lines.append(f"httpico_sent_bytes_total {self.bytesout}")
+        for phase in self.phases:
+            name = f"httpico_{phase}_seconds"
+            lines.append(f"# TYPE {name} histogram")
+            self.renderhistogram(lines, name, "", self.phasetimes[phase])
+        lines.append("# TYPE httpico_request_seconds histogram")
+        for route, hist in sorted(self.routes.items()):
+            route = route.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+            self.renderhistogram(
+                lines, "httpico_request_seconds", f'route="{route}",', hist
+            )
+        lines.append("")
+        return "\n".join(lines)
+
+    def renderhistogram(self, lines, name, labels, hist):
+        total = 0
+        for le, n in zip(self.buckets + ("+Inf",), hist):
+            total += n  # buckets are cumulative in the output
+            lines.append(f'{name}_bucket{{{labels}le="{le}"}} {total}')
+        labels = "{" + labels[:-1] + "}" if labels else ""
+        lines.append(f"{name}_sum{labels} {hist[-1]:.6f}")
+        lines.append(f"{name}_count{labels} {total}")
+
+
+class Connection:
+    """per client state kept by the serve_forever event loop"""
+
+    def __init__(self, sock, addr):
+        self.sock = sock
+        self.addr = addr
+        self.inbuf = bytearray()  # received but not yet parsed
+        # pending piece of the response, sent without copying
+        self.outbuf = memoryview(b"")
+        self.chunks = None  # generator/FileBody with the rest of the response body
+        self.closing = False  # close once the response has been sent
+        self.closed = False
+        self.req = None  # request whose headers/body are being received
+        self.nrequests = 0  # requests answered on this connection
+        self.lastactive = time.time()  # for the idle timeout
+        self.sse = None  # EventStream this connection is subscribed to
+        self.pending = None  # latest event stream update not yet being sent
+        self.ssechunked = False  # updates are framed as chunks (HTTP/1.1)
+        self.ws = None  # WebSocket, once the connection has been upgraded
+        self.sending = None  # request whose response is being sent, for metrics
+        self.busysince = None  # clock() since when a blocking handler runs for req
+        self.sendstart = None  # clock() when that response was queued
 
 
 class Response:
+    """
+    builds responses as bytes. status lines and header lines which repeat
+    from response to response are encoded once and reused, the head and
+    body are joined in a single allocation.
+    """
+
+    statustext = {
+        101: "Switching Protocols",  # websocket upgrade
+        200: "OK",
+        201: "Created",
+        202: "Accepted",  # used for successful delete
+        204: "No Content",  # delete sucessful but no content/body will be returned
+        206: "Partial Content",  # Range requests
+        304: "Not Modified",  # conditional GET, the cached copy is still good
+        404: "Not Found",
+        400: "Bad Request",
+        413: "Payload Too Large",
+        431: "Request Header Fields Too Large",
+        416: "Range Not Satisfiable",
+        500: "Internal Server Error",
+    }
+    contenttype = {
+        NoneType: "text/html; charset=UTF-8",
+        str: "text/html; charset=UTF-8",
+        dict: "application/json",
+        bytes: "application/octet-stream",
+    }
+    statuslines = {}  # (version, statuscode) -> b"HTTP/1.1 200 OK\r\n"
+    headerlines = {}  # (key, value) -> b"key: value\r\n", for repeating values
+    maxheaderlines = 64  # bound on the header line cache
+    # headers whose values repeat, others (ETag, Content-Range..) are one-offs
+    staticheaders = {
+        "Content-Type",
+        "Connection",
+        "Content-Encoding",
+        "Transfer-Encoding",
+        "Vary",
+        "Cache-Control",
+        "Accept-Ranges",
+        "Upgrade",
+        "Access-Control-Allow-Origin",
+        "Access-Control-Allow-Methods",
+        "Access-Control-Allow-Headers",
+    }
+    compressmin = 1024  # bodies smaller than this are not worth compressing
+
     def __init__(self):
-        self.statustext = {
-            200: "OK",
-            201: "Created",
-            202: "Accepted",  # used for successful delete
-            204: "No Content",  # delete sucessful but no content/body will be returned
-            404: "Not Found",
-            400: "Bad Request",
-            500: "Internal Server Error",
-        }
-        self.contenttype = {
-            NoneType: "text/html; charset=UTF-8",
-            str: "text/html; charset=UTF-8",
-            dict: "application/json",
-        }
         self.statuscode = 0  # inital val
 
-    def __call__(self, body, request, statuscode=200, headers={}):
+    @staticmethod
+    def statusfor(body, method, statuscode):
+        """the status code sent for body, None is not found (GET)/bad request (POST)"""
+        if body is None:
+            if method == "GET":
+                return 404
+            elif method == "POST":
+                return 400
+        return statuscode
+
+    def statusline(self, version, statuscode):
+        if (line := self.statuslines.get((version, statuscode))) == None:
+            # any code a handler returns
+            text = self.statustext.get(statuscode, "Unknown")
+            line = f"{version} {statuscode} {text}\r\n".encode()
+            self.statuslines[(version, statuscode)] = line
+        return line
+
+    def headerline(self, key, val):
+        if type(val) is int:  # lengths etc. differ every time, not worth caching
+            return b"%s: %d\r\n" % (key.encode(), val)
+        if key not in self.staticheaders:
+            return f"{key}: {val}\r\n".encode()
+        if (line := self.headerlines.get((key, val))) == None:
+            line = f"{key}: {val}\r\n".encode()
+            if len(self.headerlines) < self.maxheaderlines:
+                self.headerlines[(key, val)] = line
+        return line
+
+    def __call__(self, body, request, statuscode=200, headers={}, encoding=None):
         # prepare body
         bodytype = type(body)
-        body = (
-            body if bodytype in [str, dict] else str(body)
-        )  # to str if not str/dict(json)
-        body = json.dumps(body) if bodytype is dict else body  # to json if a dict
+        if bodytype is dict:
+            body = json.dumps(body).encode()  # to json if a dict
+        elif bodytype is str:
+            body = body.encode()
+        elif bodytype is not bytes:
+            body = str(body).encode()  # to str if not str/dict(json)/bytes
 
         # if body == None, then just fill statuscode with 404/400 for GET/POST
         if bodytype == NoneType:
-            if request.method == "GET":
-                statuscode = 404  # not found
-            elif request.method == "POST":
-                statuscode = 400  # Bad request
+            statuscode = self.statusfor(None, request.method, statuscode)
 
         # set headers
-        header = {"Content-Type": self.contenttype[bodytype]}
-        header.update({"Content-Length": len(body)})
+        header = {
+            "Content-Type": self.contenttype.get(bodytype, self.contenttype[str]),
+            "Content-Length": len(body),
+            "Connection": "keep-alive" if request.keepalive else "close",
+        }
         header.update(headers)  # custom headers, will override above ones if present
 
-        header = "\r\n".join([f"{k}: {v}" for k, v in header.items()])
-
-        header0 = [f"{request.version} {statuscode} {self.statustext[statuscode]}"]
-        header = f"{header0}\r\n{header}\r\n"
+        # gzip/deflate, if negotiated and the body is large and compressible
+        if (
+            encoding != None
+            and len(body) >= self.compressmin
+            and compressible(header["Content-Type"] or "")
+            and "Content-Encoding" not in header
+        ):
+            body = compress(body, encoding)
+            header["Content-Length"] = len(body)
+            header["Content-Encoding"] = encoding
+            header["Vary"] = "Accept-Encoding"
+
+        parts = [self.statusline(request.version or "HTTP/1.1", statuscode)]
+        for k, v in header.items():
+            if v != None:  # None drops a header
+                parts.append(self.headerline(k, v))
+        parts.append(b"\r\n")
+        parts.append(body)
 
         # return response
-        response = f"{header}\r\n{body}"
-        return response
+        return b"".join(parts)
+
+
+# static parts of the file browser page, served once and cached by the browser
+FBASSETS = "/__httpico__/"  # route prefix of the assets
+
+FBCSS = """
+body{
+    background: black;
+    font-family: monospace
+}
+h2{
+    color: indianred;
+}
+h3{
+    color: gold;
+}
+table {
+  width: 50%;
+  border-collapse: collapse; /* Remove double borders */
+  text-align: left; /* Align text to the left */
+  /* font-family: monospace;*/ /* Clean font */
+  font-size: 16px; /* Legible size */
+}
+
+th, td {
+  /*padding: 10px; *//* Equal spacing */
+  /* border: 1px solid #ddd; *//* Light border */
+  color: gray;
+}
+
+thead {
+  font-weight: bold;
+  font-style: italic;
+}
+
+form label{
+    color: deepskyblue;
+    font-weight: bold;
+    font-size: 1.25em;
+    text-decoration: underline;
+    margin-right: 1em;
+}
+form input::file-selector-button{
+    background: lightSteelBlue;
+}
+form input[type=file]{
+    color: deepskyblue;
+    font-style: italic;
+    font-weight: bold;
+}
+form input[type=submit]{
+    background: lightSteelBlue
+}
+
+#createfolder, #newfoldername{
+    border-radius: 1em;
+    background: silver;
+    
+}
+"""
+
+FBJS = """
+function deletefile(filename){
+    if(!confirm("Delete file: " + filename + "! Sure?")) return;
+    fetch(url=filename, {method: 'DELETE'}).then(response => response.json()).then(data=>{console.log(data);if(data.status==0)window.location.reload(true)});
+}
+
+
+function mkdir(foldername){
+    if(foldername=="") return;
+    if(foldername.includes("/") | foldername.includes(".")) {
+        alert("'/' and '.' cannot be part of the folder name");
+        return;
+    }
+    //confirm("Create new folder? Name: " + foldername )
+    fetch(url=foldername, {method: "PUT"}).then(response => response.json()).then(data => {console.log(data); if(data.status==0)window.location.reload(true)})
+}
+"""
 
 
 class HTTPico:
-    def __init__(self, host, port, fbroot=None, fbroute=""):
+    # bodies of the answers to requests which could not be read
+    rejections = {
+        400: "400 | BAD REQUEST !!!",
+        413: "413 | PAYLOAD TOO LARGE !!!",
+        431: "431 | REQUEST HEADER FIELDS TOO LARGE !!!",
+        500: "500 | INTERNAL SERVER ERROR !!!",
+    }
+
+    def __init__(
+        self,
+        host,
+        port,
+        fbroot=None,
+        fbroute="",
+        spooldir=None,
+        chunksize=2048,
+        compress=False,
+        workers=4,
+    ):
         """
         enable filebrowser with root at fbroot
         fbroot cannot start with a dot relative path
@@ -181,6 +1266,18 @@ class HTTPico:
 
         fbroute is the webroot where the file browser will lie w.r.t
         the web domain.
+
+        spooldir is where uploaded files are streamed to while the request
+        is received (defaults to fbroot, so that they can be moved in place).
+
+        chunksize is the read size when streaming files without sendfile.
+
+        compress gzips (or deflates) text responses on the fly for clients
+        which accept it, precompressed file.gz siblings of served files are
+        used regardless.
+
+        workers is the no. of threads handlers registered with blocking=True
+        run on in serve_forever.
         """
         self.host = host
         self.port = port
@@ -188,10 +1285,19 @@ class HTTPico:
         self.sock.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)  # reuse
 
         # handlers registry
-        self.gets = {}
-        self.posts = {}
-        self.puts = {}
-        self.deletes = {}
+        self.router = Router()
+        self.respcache = ResponseCache()  # for routes with a cache_ttl
+        self.metrics = Metrics()
+        self.metricsroute = "/metrics"  # prometheus scrape endpoint, None disables it
+        self.eventstreams = {}  # route -> EventStream
+        self.websockets = {}  # route -> websocket message handler
+        self.sel = None  # selector of the running serve_forever loop
+        self.workers = workers
+        self.pool = None  # WorkerPool, started with the first blocking handler
+        # (conn, req, result, error) of blocking handlers which are done
+        self.finished = []
+        self.finishedlock = _thread.allocate_lock() if _thread != None else None
+        self.wakeup = None  # socketpair, written to by workers when they finish
 
         # Req parser and Resp generator
         self.request = Request()
@@ -200,12 +1306,28 @@ class HTTPico:
         # logger
         self.logger = logging.getLogger(__name__)
 
+        self.running = False  # serve_forever loop flag
+        self.deadline = None  # time.time() by which a graceful stop() ends the loop
+
         if fbroot != None:
-            assert not fbroot.startswith(
-                "."
-            ), "fbroot cannot be a dot relative path, i.e it cannot start with a dot(.)"
+            assert not fbroot.startswith("."), (
+                "fbroot cannot be a dot relative path, i.e it cannot start with a dot(.)"
+            )
             assert fbroot.endswith("/"), "fbroot must end with forward slash(/)"
         self.fbroot = fbroot
+        self.spooldir = spooldir if spooldir != None else (fbroot or "")
+        self.chunksize = chunksize
+        self.compress = compress and zlib != None
+        self.cachecontrols = {}  # route prefix -> Cache-Control value, see cache()
+        self.listings = {}  # directory -> (mtime, [(name, isdir)]), see listdir()
+        self.maxlistings = 32  # no. of directory listings kept cached
+        self.assets = {}  # route -> (content type, body, etag)
+        for name, conttype, asset in (
+            ("filebrowser.css", "text/css", FBCSS.encode()),
+            ("filebrowser.js", "application/javascript", FBJS.encode()),
+        ):
+            self.assets[FBASSETS + name] = conttype, asset, f'"{crc32(asset):x}"'
+        self.cacheprefixes = []
         if fbroute != "":
             assert fbroute.endswith("/"), "fbroute must end with forward slash(/)"
 
@@ -216,238 +1338,1114 @@ class HTTPico:
     def start(self, timeout=None, conn_queue_size=7):
         self.sock.bind((self.host, self.port))
         self.sock.listen(conn_queue_size)
+        self.conn_queue_size = conn_queue_size
         # at max 7 connections can be waiting in the backlog queue
         # while we are processing and responding to the current one
 
     def serve(self, rcvbufsize=4096):
+        """accept a single client, answer its request and close it (blocking)"""
         clientsock, clientaddr = self.sock.accept()
+        if TCP_NODELAY != None:
+            clientsock.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
         try:
-            rawreq = clientsock.recv(
-                rcvbufsize
-            ).decode()  # request should be within these no. of bytes
-
-            req = self.request
-            req(rawreq)
-
-            if req.method == "OPTIONS":  # for AJAX preflight
-                # allow all methods from all urls
-                opt_response = """
-                HTTP/1.1 204 No Content
-                Access-Control-Allow-Origin: *
-                Access-Control-Allow-Methods: GET, POST, OPTIONS, PUT, DELETE
-                Access-Control-Allow-Headers: Content-Type
-                """
-                clientsock.sendall(opt_response)
-
-            elif req.method == "GET":
-                # registered gets
-                if req.route in self.gets:
-                    stscode = 200
-                    cb = self.gets[req.route]
-                    argnames = cb.__code__.co_varnames[: cb.__code__.co_argcount]
-                    kwargs = {}
-                    for arg in argnames:
-                        kwargs[arg] = req.query[arg] if arg in req.query else None
-                    rawresp = cb(**kwargs)
-                    if len(rawresp) > 1:
-                        stscode, rawresp = rawresp
-                    resp = self.response(rawresp, req, statuscode=stscode)
-                    clientsock.sendall(resp.encode())  # send the response
-
-                # serve files (if starts with fbroute)
-                elif (rawresp := self.filebrowse(req.route, method=req.method)) != (
-                    None,
-                    None,
+            req = Request(self.spooldir)
+            rawreq = b""
+            while rawreq.find(b"\r\n\r\n") < 0:
+                if len(rawreq) > Request.maxhead:
+                    self.metrics.status(431)
+                    clientsock.sendall(self.response(self.rejections[431], req, 431))
+                    return
+                data = clientsock.recv(rcvbufsize)
+                if not data:  # client hung up before sending a full request
+                    return
+                rawreq += data
+            self.metrics.bytesin += len(rawreq)
+            req.started = clock()
+            try:
+                req(rawreq)  # parses the headers and feeds the start of the body
+                self.metrics.phase("parse", clock() - req.started)
+
+                # stream the rest of the body (uploads are spooled to disk part by part)
+                while req.remaining:
+                    if not (data := clientsock.recv(rcvbufsize)):
+                        return
+                    self.metrics.bytesin += len(data)
+                    req.feed(data)
+            except Exception as e:
+                self.logger.info(f"Exception: {e}")
+                stscode = self.rejection(e)
+                self.metrics.status(stscode)
+                clientsock.sendall(
+                    self.response(self.rejections[stscode], req, stscode)
+                )
+                return
+
+            handlerstart = clock()
+            resp, chunks = self.handle(req)
+            sendstart = clock()
+            self.metrics.phase("handler", sendstart - handlerstart)
+            clientsock.sendall(resp)  # send the response (headers)
+            self.metrics.bytesout += len(resp)
+            if req.ws != None:  # websocket, blocks until either side closes it
+                ws = WebSocket(req.ws)
+                # frames sent along the handshake
+                data = rawreq[rawreq.find(b"\r\n\r\n") + 4 :]
+                while not ws.closing and (
+                    data or (data := clientsock.recv(rcvbufsize))
                 ):
-                    stscode = 200
-                    filesize, chunked_fileread_generator = rawresp
-                    resp = self.response(
-                        body="",
-                        request=req,
-                        statuscode=stscode,
-                        headers={"Content-Length": filesize},
-                    )
-                    clientsock.sendall(resp.encode())  # send headers
-                    for chunk in chunked_fileread_generator:  # send the body in chunks to not overflow the RAM as the files could be really large to directly load to RAM
-                        clientsock.sendall(chunk.encode())
+                    ws.feed(data)
+                    data = b""
+                    while ws.outq:
+                        clientsock.sendall(ws.outq.pop(0))
+                while ws.outq:  # close frame
+                    clientsock.sendall(ws.outq.pop(0))
+            elif req.sse != None:  # event stream, blocks until the client goes away
+                chunked = req.version == "HTTP/1.1"
+                clientsock.settimeout(req.sse.interval)  # the wait between ticks
+                sent, lastsent = False, None  # what this client has got so far
+                while True:
+                    try:
+                        data = req.sse.producer()
+                    except Exception as e:  # skip this update
+                        self.logger.info(f"Exception in event stream producer: {e}")
+                    else:
+                        if not sent or data != lastsent:
+                            sent, lastsent = True, data
+                            req.sse.lastdata = data
+                            req.sse.encode(data)
+                            try:
+                                clientsock.sendall(req.sse.frame(chunked))
+                            except OSError:  # the client went away
+                                return
+                    try:  # nothing is expected from the client, except a hangup
+                        if not clientsock.recv(rcvbufsize):
+                            return
+                    except SocketTimeout:
+                        pass
+                    except OSError:
+                        return
+            elif type(chunks) is FileBody and sendfile != None:
+                while sent := chunks.sendfile(clientsock):
+                    self.metrics.bytesout += sent
+            elif chunks != None:
+                # send the body in chunks to not overflow the RAM as the files could be really large to directly load to RAM
+                for chunk in chunks:
+                    clientsock.sendall(chunk)
+                    self.metrics.bytesout += len(chunk)
+            if req.ws == None and req.sse == None:
+                now = clock()
+                self.metrics.phase("send", now - sendstart)
+                self.metrics.request(req.label or "other", now - req.started)
 
-                # not found
-                else:
-                    stscode = 404
-                    rawresp = f"{stscode} | NOT FOUND !!!"
-                    resp = self.response(rawresp, req, stscode)
-                    clientsock.sendall(resp.encode())
-
-            # HANDLE POSTs
-            elif req.method == "POST":
-                if req.route in self.posts:
-                    stscode = 201
-                    cb = self.posts[req.route]
-                    argnames = cb.__code__.co_varnames[
-                        : cb.__code__.co_argcount
-                    ]  # get names of arguments
-                    kwargs = {}
-                    for arg in argnames:
-                        kwargs[arg] = req.form[arg] if arg in req.form else None
-                    rawresp = cb(**kwargs)
-                    if len(rawresp) > 1:
-                        stscode, rawresp = rawresp
-                    resp = self.response(rawresp, req, statuscode=stscode)
-                    clientsock.sendall(resp.encode())  # send the response
-
-                # write/save files (if starts with fbroute)
-                elif (rawresp := self.filebrowse(req.route, method=req.method)) != (
-                    None,
-                    None,
-                ):
-                    stscode = 200
-                    filesize, chunked_fileread_generator = rawresp
-                    resp = self.response(
-                        body="",
-                        request=req,
-                        statuscode=stscode,
-                        headers={"Content-Length": filesize},
-                    )
-                    clientsock.sendall(resp.encode())  # send headers
+        except Exception as e:
+            raise
+            self.logger.info(f"Exception: {e}")
+        finally:
+            req.cleanup()
+            clientsock.close()
 
-                else:
-                    stscode = 400
-                    rawresp = f"{stscode} | BAD REQUEST !!!"
-                    resp = self.response(rawresp, req, stscode)
-                    clientsock.sendall(resp.encode())
-
-            # handle new folder creation
-            elif req.method == "PUT":
-                if req.route in self.puts:
-                    stscode = 200
-                    cb = self.puts[req.route]
-                    argnames = cb.__code__.co_varnames[
-                        : cb.__code__.co_argcount
-                    ]  # get names of arguments
-                    kwargs = {}
-                    for arg in argnames:
-                        kwargs[arg] = req.form[arg] if arg in req.form else None
-                    rawresp = cb(**kwargs)
-                    if len(rawresp) > 1:
-                        stscode, rawresp = rawresp
-                    resp = self.response(rawresp, req, statuscode=stscode)
-                    clientsock.sendall(resp.encode())  # send the response
-
-                # mkdir (if starts with fbroute)
-                elif (rawresp := self.filebrowse(req.route, method=req.method)) != (
-                    None,
-                    None,
-                ):
-                    stscode, body = rawresp
-                    resp = self.response(
-                        body=body,
-                        request=req,
-                        statuscode=stscode,
-                    )
-                    clientsock.sendall(resp.encode())  # send headers
-
-            # handle delete file in filebrowser
-            elif req.method == "DELETE":
-                if req.route in self.deletes:
-                    stscode = 200
-                    cb = self.deletes[req.route]
-                    argnames = cb.__code__.co_varnames[
-                        : cb.__code__.co_argcount
-                    ]  # get names of arguments
-                    kwargs = {}
-                    for arg in arcgnames:
-                        kwargs[arg] = req.form[arg] if arg in req.form else None
-                    rawresp = cb(**kwargs)
-                    if len(rawresp) > 1:
-                        stscode, rawresp = rawresp
-                    resp = self.response(rawresp, req, statuscode=stscode)
-                    clientsock.sendall(resp.encode())  # send the response
-
-                elif (rawresp := self.filebrowse(req.route, method=req.method)) != (
-                    None,
-                    None,
-                ):
-                    stscode, rawresp = rawresp
-                    resp = self.response(rawresp, req, statuscode=stscode)
-                    clientsock.sendall(resp.encode())  # send the response
+    def serve_forever(
+        self, rcvbufsize=4096, timeout=1, idle_timeout=5, max_requests=100
+    ):
+        """
+        non-blocking event loop which multiplexes many clients.
+        every connection keeps its own in/out buffers, so a slow client
+        (partial reads or writes) never holds up the others. the registered
+        handlers run in between the I/O events. returns after stop().
+
+        connections are kept alive (HTTP/1.1) for up to max_requests
+        requests and closed after idle_timeout seconds without traffic.
+        pipelined requests are answered one after the other, in order.
+        """
+        self.idle_timeout = idle_timeout
+        self.max_requests = max_requests
+        self.sel = sel = DefaultSelector()
+        self.sock.setblocking(False)
+        sel.register(self.sock, EVENT_READ, None)  # data=None marks the listener
+        if socketpair != None:
+            self.wakeup = socketpair()
+            for s in self.wakeup:
+                s.setblocking(False)
+            # data=False marks the wakeup
+            sel.register(self.wakeup[0], EVENT_READ, False)
+        self.running = True
+        self.deadline = None
+        lastsweep = time.time()
+        try:
+            while self.running:
+                # wake up in time for the next event stream update
+                waitfor = self._tick()
+                waitfor = timeout if waitfor == None else min(waitfor, timeout)
+                # poll for finished handlers
+                if self.pool != None and self.wakeup == None:
+                    waitfor = min(waitfor, 0.01)
+                for key, events in sel.select(waitfor):
+                    if key.data is None:
+                        self._accept(sel)
+                        continue
+                    if key.data is False:
+                        self._finished(sel)
+                        continue
+                    conn = key.data
+                    if events & EVENT_READ:
+                        self._read(sel, conn, rcvbufsize)
+                    if events & EVENT_WRITE and not conn.closed:
+                        self._write(sel, conn)
+                if self.wakeup == None and self.finished:
+                    self._finished(sel)
+
+                # graceful stop, let the responses in flight finish
+                if self.deadline != None:
+                    inflight = 0
+                    for key in list(sel.get_map().values()):
+                        conn = key.data
+                        if not conn:
+                            continue
+                        if conn.req or conn.outbuf or conn.chunks or conn.busysince:
+                            inflight += 1
+                        else:  # idle keep-alive, event stream or websocket
+                            self._close(sel, conn)
+                    if not inflight or time.time() >= self.deadline:
+                        self.running = False
+
+                # drop idle keep-alive connections, at most once per second
+                if (now := time.time()) - lastsweep >= 1:
+                    lastsweep = now
+                    for key in list(sel.get_map().values()):
+                        conn = key.data
+                        if (
+                            conn
+                            # waiting for its handler is not idling
+                            and conn.busysince == None
+                            and conn.sse == None  # event streams stay open
+                            and conn.ws == None  # so do websockets
+                            and now - conn.lastactive > idle_timeout
+                        ):
+                            self._close(sel, conn)
+        finally:
+            for key in list(sel.get_map().values()):
+                if key.data:
+                    self._close(sel, key.data)
+            if self.pool != None:
+                self.pool.shutdown()
+                self.pool = None
+            if self.wakeup != None:
+                for s in self.wakeup:
+                    s.close()
+                self.wakeup = None
+            sel.close()
+            self.sel = None
+
+    def _accept(self, sel):
+        try:
+            clientsock, clientaddr = self.sock.accept()
+        except (BlockingIOError, InterruptedError):
+            return  # another process/thread won the race
+        clientsock.setblocking(False)
+        # a head and a sendfile'd body must not wait on delayed acks
+        if TCP_NODELAY != None:
+            clientsock.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+        sel.register(clientsock, EVENT_READ, Connection(clientsock, clientaddr))
+
+    def _read(self, sel, conn, rcvbufsize):
+        try:
+            data = conn.sock.recv(rcvbufsize)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b""
+        if not data:  # client closed the connection
+            self._close(sel, conn)
+            return
+        self.metrics.bytesin += len(data)
+        if conn.sse != None:
+            return  # nothing is expected from event stream subscribers
+        conn.lastactive = time.time()
+        if conn.ws != None:  # upgraded, data is websocket frames
+            conn.ws.feed(data)
+            return
+        conn.inbuf += data
+        self._process(sel, conn)
 
-                else:
-                    stscode = 400
-                    rawresp = f"{stscode} | BAD REQUEST !!!"
-                    resp = self.response(rawresp, req, stscode)
-                    clientsock.sendall(resp.encode())
+    def _process(self, sel, conn):
+        """
+        parse what is buffered on conn. the body is streamed into the
+        request as it arrives, which is answered once it is complete.
+        """
+        if conn.busysince != None:
+            return  # its blocking handler is still running, see _finished()
+        if conn.req == None:  # waiting for the headers of a new request
+            if (header_end := conn.inbuf.find(b"\r\n\r\n")) < 0:
+                if len(conn.inbuf) > Request.maxhead:  # don't buffer it without end
+                    conn.req = Request(self.spooldir)
+                    self._reject(sel, conn, 431)
+                return
+            conn.nrequests += 1
+            conn.req = req = Request(self.spooldir)
+            req.started = clock()
+            try:
+                req(conn.inbuf[: header_end + 4])
+            except Exception as e:
+                self.logger.info(f"Exception: {e}")
+                self._reject(sel, conn, self.rejection(e))
+                return
+            self.metrics.phase("parse", clock() - req.started)
+            del conn.inbuf[: header_end + 4]
+
+        req = conn.req
+        if req.remaining:
+            try:
+                with memoryview(conn.inbuf) as mv:
+                    used = req.feed(mv)
+            # a malformed body, or the upload could not be spooled
+            except Exception as e:
+                self.logger.info(f"Exception: {e}")
+                self._reject(sel, conn, self.rejection(e))
+                return
+            del conn.inbuf[:used]
+            if req.remaining:
+                return  # wait for the rest of the body
+
+        handlerstart = clock()
+        try:
+            req.keepalive = conn.nrequests < self.max_requests and req.wants_keepalive()
+            resp, chunks = self.handle(req)
+        except Exception as e:
+            self.logger.info(f"Exception: {e}")
+            req.keepalive = False
+            self.log(req, 500)
+            resp, chunks = (
+                self.response("500 | INTERNAL SERVER ERROR !!!", req, 500),
+                None,
+            )
+        if req.deferred != None:  # blocking handler, answered by _finished()
+            conn.busysince = handlerstart
+            self._submit(conn, req)
+            return
+        self.metrics.phase("handler", clock() - handlerstart)
+        req.cleanup()
+        self._respond(sel, conn, resp, chunks)
+
+    def _submit(self, conn, req):
+        """run the blocking handler of req on the worker pool"""
+        if self.pool == None:
+            self.pool = WorkerPool(self.workers)
+        route, pathparams, fields = req.deferred[:3]
+
+        def done(result, error):  # in the worker thread
+            with self.finishedlock:
+                self.finished.append((conn, req, result, error))
+            if self.wakeup != None:
+                try:
+                    self.wakeup[1].send(b"\0")
+                except OSError:  # full, the loop has a wakeup pending anyway
+                    pass
+
+        self.pool.submit(route, (pathparams, fields), done)
+
+    def _finished(self, sel):
+        """answer the requests whose blocking handlers are done"""
+        if self.wakeup != None:
+            try:
+                self.wakeup[0].recv(4096)
+            except (BlockingIOError, InterruptedError):
+                pass
+        with self.finishedlock:
+            finished, self.finished = self.finished, []
+        for conn, req, result, error in finished:
+            handlerstart, conn.busysince = conn.busysince, None
+            if conn.closed:  # the client has gone meanwhile
+                req.cleanup()
+                continue
+            route, _, _, cachekey, mtimes = req.deferred
+            try:
+                if error != None:
+                    raise error
+                stscode, resp, chunks = self.handlerresponse(
+                    req, route, result, cachekey, mtimes
+                )
+            except Exception as e:
+                self.logger.info(f"Exception: {e}")
+                req.keepalive = False
+                stscode, chunks = 500, None
+                resp = self.response("500 | INTERNAL SERVER ERROR !!!", req, 500)
+            self.log(req, stscode)
+            self.metrics.phase("handler", clock() - handlerstart)
+            req.cleanup()
+            self._respond(sel, conn, resp, chunks)
+
+    def _reject(self, sel, conn, stscode):
+        """answer a request which could not be read with stscode, and close"""
+        req = conn.req
+        conn.inbuf = bytearray()  # not resized, a view of it may still be around
+        req.remaining = 0
+        req.keepalive = False
+        req.cleanup()
+        self.metrics.status(stscode)
+        self._respond(
+            sel, conn, self.response(self.rejections[stscode], req, stscode), None
+        )
+
+    @staticmethod
+    def rejection(e):
+        """status code for a request which raised e while it was read"""
+        if isinstance(e, TooLarge):
+            return 413
+        return 500 if isinstance(e, OSError) else 400
+
+    def _respond(self, sel, conn, resp, chunks):
+        """queue the response on conn and start writing it"""
+        req, conn.req = conn.req, None
+        conn.sending, conn.sendstart = req, clock()
+        conn.outbuf = memoryview(resp)
+        conn.chunks = chunks
+        conn.closing = not req.keepalive
+        if req.sse != None:  # event stream, updates are pushed in by publish()
+            conn.sse = req.sse
+            conn.ssechunked = req.version == "HTTP/1.1"
+            conn.closing = False
+            req.sse.subscribers.add(conn)
+            if req.sse.lastframe != None:  # start with the latest value
+                conn.pending = req.sse.frame(conn.ssechunked)
+        if req.ws != None:  # upgraded, from now on websocket frames flow both ways
+            conn.ws = WebSocket(req.ws, notify=lambda: self._wswrite(conn))
+            conn.closing = False
+        # stop reading while the response is being written, pipelined
+        # requests wait in the socket/inbuf until it is done
+        sel.modify(conn.sock, EVENT_WRITE, conn)
+        self._write(sel, conn)  # try right away, most responses fit the socket buffer
+
+    def _write(self, sel, conn):
+        while True:
+            if not conn.outbuf and type(conn.chunks) is FileBody and sendfile != None:
+                try:  # file straight to the socket, no copy through python
+                    sent = conn.chunks.sendfile(conn.sock)
+                except (BlockingIOError, InterruptedError):
+                    return  # socket buffer full, wait for the next EVENT_WRITE
+                except OSError:
+                    self._close(sel, conn)
+                    return
+                if sent == 0:
+                    conn.chunks = None
+                self.metrics.bytesout += sent
+                conn.lastactive = time.time()
+                continue
+            # refill from the body generator
+            if not conn.outbuf and conn.chunks != None:
+                try:
+                    chunk = next(conn.chunks, None)
+                # the head is out, all left is to cut the body short
+                except Exception as e:
+                    self.logger.info(f"Exception in response body: {e}")
+                    conn.chunks = None
+                    self._close(sel, conn)
+                    return
+                if chunk == None:
+                    conn.chunks = None
+                else:  # FileBody chunks are only valid until the next one is read
+                    conn.outbuf = memoryview(chunk)
+                    continue
+            if not conn.outbuf and conn.pending != None:  # next event stream update
+                conn.outbuf, conn.pending = memoryview(conn.pending), None
+                continue
+            # next websocket frame
+            if not conn.outbuf and conn.ws != None and conn.ws.outq:
+                conn.outbuf = memoryview(conn.ws.outq.pop(0))
+                continue
+            if not conn.outbuf:
+                break
+            try:
+                sent = conn.sock.send(conn.outbuf)
+            except (BlockingIOError, InterruptedError):
+                return  # socket buffer full, wait for the next EVENT_WRITE
+            except OSError:
+                self._close(sel, conn)
+                return
+            conn.outbuf = conn.outbuf[sent:]
+            self.metrics.bytesout += sent
+            conn.lastactive = time.time()
+
+        if conn.sending != None:  # the response is out (or the upgrade/stream head)
+            now, req, conn.sending = clock(), conn.sending, None
+            self.metrics.phase("send", now - conn.sendstart)
+            if req.started != None:
+                self.metrics.request(req.label or "other", now - req.started)
+
+        if conn.closing or (conn.ws != None and conn.ws.closing):
+            self._close(sel, conn)
+        elif conn.ws != None:  # all sent, back to reading frames
+            sel.modify(conn.sock, EVENT_READ, conn)
+            if conn.inbuf:  # frames which came along with the handshake
+                data, conn.inbuf = bytes(conn.inbuf), bytearray()
+                conn.ws.feed(data)
+        elif conn.sse != None:  # wait for the next update, reading only tells a hangup
+            sel.modify(conn.sock, EVENT_READ, conn)
+        else:  # keep-alive, go on with the next (pipelined) request
+            sel.modify(conn.sock, EVENT_READ, conn)
+            self._process(sel, conn)
+
+    def _wswrite(self, conn):
+        """frames were queued on a websocket, write them unless already writing"""
+        if conn.closed or self.sel == None or conn.outbuf:
+            return  # a write in progress picks them up
+        self.sel.modify(conn.sock, EVENT_READ | EVENT_WRITE, conn)
+        self._write(self.sel, conn)
+
+    def _close(self, sel, conn):
+        if conn.closed:
+            return
+        conn.closed = True
+        # hung up in the middle of an upload
+        if conn.req != None and conn.busysince == None:
+            conn.req.cleanup()
+        if conn.chunks != None:  # hung up in the middle of a download
+            if hasattr(conn.chunks, "close"):
+                conn.chunks.close()
+            conn.chunks = None
+        if conn.sse != None:
+            conn.sse.subscribers.discard(conn)
+        try:
+            sel.unregister(conn.sock)
+        except (KeyError, ValueError):
+            pass
+        conn.sock.close()
+
+    def handle(self, req):
+        """
+        route a parsed request to its handler.
+        returns the response (headers + body) and an optional generator
+        of body chunks to be sent after it.
+        """
+        chunks = None
+        if req.method == "OPTIONS":  # for AJAX preflight
+            # allow all methods from all urls
+            stscode = 204
+            resp = self.response(
+                "",
+                req,
+                statuscode=stscode,
+                headers={
+                    "Access-Control-Allow-Origin": "*",
+                    "Access-Control-Allow-Methods": "GET, POST, OPTIONS, PUT, DELETE",
+                    "Access-Control-Allow-Headers": "Content-Type",
+                },
+            )
+
+        # server-sent event streams
+        elif req.method == "GET" and req.route in self.eventstreams:
+            stscode, req.sse = 200, self.eventstreams[req.route]
+            req.label = req.route
+            headers = {
+                "Content-Type": "text/event-stream",
+                "Cache-Control": "no-cache",
+                "Content-Length": None,
+            }
+            if req.version == "HTTP/1.1":
+                headers["Transfer-Encoding"] = "chunked"
+                req.keepalive = True
+            resp = self.response("", req, statuscode=stscode, headers=headers)
+
+        # websocket upgrades
+        elif req.method == "GET" and req.route in self.websockets:
+            key = req.headers.get("Sec-WebSocket-Key")
+            if req.headers.get("Upgrade", "").lower() != "websocket" or key == None:
+                stscode = 400
+                resp = self.response(f"{stscode} | BAD REQUEST !!!", req, stscode)
+            else:
+                stscode, req.ws = 101, self.websockets[req.route]
+                req.label = req.route
+                headers = {
+                    "Content-Type": None,
+                    "Content-Length": None,
+                    "Connection": "Upgrade",
+                    "Upgrade": "websocket",
+                    "Sec-WebSocket-Accept": WebSocket.accept(key),
+                }
+                resp = self.response("", req, statuscode=stscode, headers=headers)
+
+        # registered handlers
+        elif (found := self.router.find(req.method, req.route)) != None:
+            route, pathparams = found
+            req.label = route.path  # /motor/{id}, not every id on its own
+            cachekey = None
+            if route.cachettl != None and req.method == "GET":
+                # the whole response is cached, so everything it depends on is in the key
+                cachekey = req.rawpath, req.version, req.keepalive, self.encoding(req)
+            if cachekey != None and (resp := self.respcache.get(cachekey)) != None:
+                stscode = 200  # only 200s are cached, the handler is not called
+            else:
+                mtimes = ResponseCache.mtimes(route.deps) if cachekey != None else None
+                fields = req.query if req.method == "GET" else req.form
+                if route.blocking and self.sel != None and _thread != None:
+                    # off to the worker pool, the loop answers it once it is done
+                    req.deferred = route, pathparams, fields, cachekey, mtimes
+                    return None, None
+                stscode, resp, chunks = self.handlerresponse(
+                    req, route, route(pathparams, fields), cachekey, mtimes
+                )
+
+        # serve files (if starts with fbroute)
+        elif (
+            req.method == "GET"
+            and (fspath := self.fbpath(req.route)) != None
+            and os.path.isfile(fspath)
+        ):
+            req.label = self.fbroute
+            stscode, resp, chunks = self.servefile(req, fspath)
+
+        # metrics, prometheus text format
+        elif req.method == "GET" and req.route == self.metricsroute:
+            stscode = 200
+            headers = {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+            resp = self.response(self.metrics.render(), req, stscode, headers)
+
+        # file browser css/js
+        elif req.method == "GET" and req.route in self.assets:
+            req.label = FBASSETS
+            conttype, body, etag = self.assets[req.route]
+            headers = {
+                "Content-Type": conttype,
+                "Content-Length": len(body),
+                "ETag": etag,
+                "Cache-Control": "max-age=86400",
+            }
+            if notmodified(req.headers, etag, 0):
+                stscode, chunks = 304, None
+            else:
+                stscode, chunks = 200, (b for b in (body,))  # closeable, unlike iter()
+            resp = self.response("", req, statuscode=stscode, headers=headers)
+
+        # directory listing as json, ?format=json (if starts with fbroute)
+        elif (
+            req.method == "GET"
+            and req.query.get("format") == "json"
+            and (fspath := self.fbpath(req.route)) != None
+            and os.path.isdir(fspath)
+        ):
+            req.label = self.fbroute
+            stscode, rawresp = self.listjson(fspath, req.query)
+            headers = self.cachecontrol(req.route)
+            resp = self.response(
+                rawresp, req, stscode, headers, encoding=self.encoding(req)
+            )
+
+        # directory listing (if starts with fbroute)
+        elif req.method == "GET" and (
+            rawresp := self.filebrowse(req.route, method=req.method)
+        ) != (None, None):
+            req.label, stscode = self.fbroute, 200
+            filesize, chunked_fileread_generator = rawresp
+            headers = {"Content-Length": filesize}
+            if filesize == None:  # streamed, length not known up front
+                chunked_fileread_generator = self.stream(
+                    req, chunked_fileread_generator, headers, self.encoding(req)
+                )
+            headers.update(self.cachecontrol(req.route))
+            resp = self.response(
+                body="",
+                request=req,
+                statuscode=stscode,
+                headers=headers,
+            )
+            # body is sent in chunks to not overflow the RAM as the files could be really large to directly load to RAM
+            chunks = chunked_fileread_generator
+
+        # mkdir/delete (if starts with fbroute)
+        elif req.method in ("PUT", "DELETE") and (
+            rawresp := self.filebrowse(req.route, method=req.method)
+        ) != (None, None):
+            req.label = self.fbroute
+            stscode, rawresp = rawresp
+            resp = self.response(rawresp, req, statuscode=stscode)
+
+        # not found
+        elif req.method == "GET":
+            stscode = 404
+            resp = self.response(f"{stscode} | NOT FOUND !!!", req, stscode)
 
-            # log
+        else:
+            stscode = 400
+            resp = self.response(f"{stscode} | BAD REQUEST !!!", req, stscode)
+
+        self.log(req, stscode)
+        return resp, chunks
+
+    def handlerresponse(self, req, route, rawresp, cachekey=None, mtimes=None):
+        """
+        the response to what a registered handler returned.
+        returns statuscode, response, body chunks (or None).
+        """
+        stscode, chunks = route.statuscode, None
+        headers = self.cachecontrol(req.route) if req.method == "GET" else {}
+        if type(rawresp) is tuple:  # (statuscode, body) or (statuscode, body, headers)
+            headers.update(*rawresp[2:])
+            stscode, rawresp = rawresp[:2]
+        # generator/iterator, stream it as it is produced
+        if hasattr(rawresp, "__next__"):
+            chunks = self.stream(
+                req, tobytes(rawresp), headers, self.encoding(req), flush=True
+            )
+            rawresp = ""
+        # as sent, for the cache, log and metrics
+        stscode = Response.statusfor(rawresp, req.method, stscode)
+        resp = self.response(
+            rawresp, req, stscode, headers, encoding=self.encoding(req)
+        )
+        if cachekey != None and stscode == 200 and chunks == None:
+            self.respcache.put(cachekey, resp, route.cachettl, route.deps, mtimes)
+        return stscode, resp, chunks
+
+    def log(self, req, stscode):
+        self.metrics.status(stscode)
+        if self.logger.isEnabledFor(logging.INFO):  # skips the formatting when off
             self.logger.info(
                 f"{req.method:<4} {req.rawpath:<50} {req.version:<8}    {stscode}"
             )
 
-        except Exception as e:
-            raise
-            self.logger.info(f"Exception: {e}")
-        finally:
-            clientsock.close()
+    def encoding(self, req):
+        """content coding to compress the response to req with, or None"""
+        if not self.compress:
+            return None
+        for coding in ("gzip", "deflate"):
+            if acceptsencoding(req.headers, coding):
+                return coding
+        return None
 
-    def stop(self):
-        self.sock.close()
+    def stream(self, req, chunks, headers, encoding=None, flush=False):
+        """
+        set up a body of unknown length: chunked for HTTP/1.1, otherwise
+        the body ends when the connection is closed. updates headers and
+        returns the chunks to be sent. with encoding (gzip/deflate) text
+        bodies are compressed on the fly, flush sends every chunk right away.
+        """
+        headers["Content-Length"] = None
+        conttype = headers.get("Content-Type", Response.contenttype[str])
+        if encoding != None and compressible(conttype or ""):
+            chunks = compresschunks(chunks, encoding, flush)
+            headers["Content-Encoding"] = encoding
+            headers["Vary"] = "Accept-Encoding"
+        if req.version == "HTTP/1.1":
+            headers["Transfer-Encoding"] = "chunked"
+            return chunkedencode(chunks)
+        req.keepalive = False  # HTTP/1.0
+        return chunks
+
+    def sse(self, path, interval=1, event=None):
+        """
+        register a server-sent events (text/event-stream) producer at path.
+        while there are subscribers, the producer is called every interval
+        seconds and its result (str/dict) is pushed to all of them when it
+        changed. a subscriber which is still busy with an older update only
+        gets the latest one (slow clients are coalesced, never queued up).
+        """
 
-    def get(self, path):
-        def wrapper(cb):
-            self.gets[path] = cb
+        def wrapper(producer):
+            self.eventstreams[path] = EventStream(producer, interval, event)
+            return producer
 
         return wrapper
 
-    def post(self, path):
-        def wrapper(cb):
-            self.posts[path] = cb
+    def websocket(self, path):
+        """
+        register a websocket handler at path. it is called as handler(ws, msg)
+        for every message, msg is str (text) or bytes (binary). whatever it
+        returns (str/dict/bytes) is sent back, ws.send()/ws.close() work
+        anytime, also from outside the handler.
+        """
+
+        def wrapper(handler):
+            self.websockets[path] = handler
+            return handler
 
         return wrapper
 
-    def delete(self, path):
+    def publish(self, path, data):
+        """push data to the subscribers of the event stream at path right away"""
+        stream = self.eventstreams[path]
+        stream.lastdata = data
+        stream.encode(data)
+        for conn in list(stream.subscribers):
+            conn.pending = stream.frame(conn.ssechunked)  # replaces an unsent older one
+            if not conn.outbuf and conn.chunks == None:  # idle, start writing
+                self.sel.modify(conn.sock, EVENT_WRITE, conn)
+                self._write(self.sel, conn)
+
+    def _tick(self):
+        """
+        run the event stream producers which are due, returns the seconds
+        until the next one is (None if there are no subscribers at all).
+        """
+        now, waitfor = time.time(), None
+        for path, stream in self.eventstreams.items():
+            if not stream.subscribers:
+                continue
+            if now >= stream.nexttick:
+                stream.nexttick = now + stream.interval
+                try:
+                    data = stream.producer()
+                except Exception as e:  # skip this tick, try again on the next
+                    self.logger.info(f"Exception in event stream producer: {e}")
+                else:
+                    if data != stream.lastdata:
+                        self.publish(path, data)
+            due = stream.nexttick - now
+            waitfor = due if waitfor == None else min(waitfor, due)
+        return waitfor
+
+    def stop(self, grace=0):
+        """
+        end serve_forever. with grace (seconds) no new connections are
+        accepted, and responses in flight get up to grace seconds to finish
+        while idle connections are closed right away.
+        """
+        if self.sel != None:
+            try:
+                self.sel.unregister(self.sock)
+            except (KeyError, ValueError):
+                pass
+        if grace and self.sel != None:
+            self.deadline = time.time() + grace
+        else:
+            self.running = False  # ends serve_forever
+        self.sock.close()
+
+    def serve_prefork(self, nworkers=None, reuseport=True, grace=5, **kwargs):
+        """
+        serve with nworkers forked processes (one per cpu by default), each
+        running serve_forever(**kwargs) with its own copy of the routes,
+        caches and metrics. call start() first.
+
+        with reuseport (and SO_REUSEPORT) every worker listens on a socket
+        of its own and the kernel spreads the connections, otherwise they
+        all accept from the inherited listening socket.
+
+        workers which exit are restarted. SIGTERM/SIGINT stop the workers
+        gracefully (see stop(grace)) and return once all are gone.
+        """
+        import signal  # not on micropython, which can't fork anyway
+
+        nworkers = nworkers or os.cpu_count() or 1
+        reuseport = reuseport and SO_REUSEPORT != None
+        addr = self.sock.getsockname()
+        if reuseport:  # workers bind their own sockets, this one would be in the way
+            self.sock.close()
+
+        workers = {}  # pid -> (worker no., time.time() when started)
+        stopping = False
+
+        def spawn(worker):
+            # no signals until the worker has its own handlers in place
+            signal.pthread_sigmask(signal.SIG_BLOCK, (signal.SIGTERM, signal.SIGINT))
+            pid = os.fork()
+            if pid != 0:
+                workers[pid] = worker, time.time()
+                signal.pthread_sigmask(
+                    signal.SIG_UNBLOCK, (signal.SIGTERM, signal.SIGINT)
+                )
+                return
+            # worker process, never returns
+            code = 0
+            try:
+                signal.signal(signal.SIGTERM, lambda signum, frame: self.stop(grace))
+                # ctrl-c reaches the supervisor too
+                signal.signal(signal.SIGINT, signal.SIG_IGN)
+                signal.pthread_sigmask(
+                    signal.SIG_UNBLOCK, (signal.SIGTERM, signal.SIGINT)
+                )
+                if reuseport:
+                    self.sock = socket(AF_INET, SOCK_STREAM)
+                    self.sock.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+                    self.sock.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1)
+                    self.sock.bind(addr)
+                    self.sock.listen(self.conn_queue_size)
+                self.serve_forever(**kwargs)
+            except BaseException as e:
+                self.logger.info(f"Exception in worker {worker}: {e}")
+                code = 1
+            finally:
+                os._exit(code)
+
+        def shutdown(signum, frame):
+            nonlocal stopping
+            stopping = True
+            for pid in workers:
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except OSError:  # already gone
+                    pass
+
+        handlers = {
+            signum: signal.signal(signum, shutdown)
+            for signum in (signal.SIGTERM, signal.SIGINT)
+        }
+        try:
+            for worker in range(nworkers):
+                spawn(worker)
+            while workers:
+                try:
+                    pid, status = os.wait()
+                except ChildProcessError:
+                    break
+                worker, started = workers.pop(pid, (None, 0))
+                if stopping or worker == None:
+                    continue
+                self.logger.info(
+                    f"worker {worker} (pid {pid}) exited ({status}), restarting"
+                )
+                if time.time() - started < 1:  # crashing right away, don't spin
+                    time.sleep(1)
+                if not stopping:
+                    spawn(worker)
+        finally:
+            for signum, handler in handlers.items():
+                signal.signal(signum, handler)
+
+    def route(self, method, path, cache_ttl=None, deps=(), blocking=False):
+        """
+        register a handler for method at path. path may contain
+        parameters, e.g /motor/{id}, which are passed to the handler
+        as keyword arguments along with the query/form fields.
+
+        the handler returns the body, or (statuscode, body) or
+        (statuscode, body, headers). a generator (or any iterator) as the
+        body is streamed with Transfer-Encoding: chunked as it yields.
+
+        with cache_ttl (seconds) GET responses are cached per path and
+        query, repeat requests skip the handler. deps are files the
+        response is built from, a change of their mtime drops it early.
+
+        blocking handlers (file I/O, waiting on a device) run on a pool of
+        worker threads in serve_forever, other clients are served meanwhile.
+        """
+
         def wrapper(cb):
-            self.deletes[path] = cb
+            route = self.router.add(method, path, cb)
+            route.cachettl, route.deps = cache_ttl, tuple(deps)
+            route.blocking = blocking
+            return cb
 
         return wrapper
 
-    def filebrowse(self, route, method):
+    def get(self, path, cache_ttl=None, deps=(), blocking=False):
+        return self.route("GET", path, cache_ttl, deps, blocking)
+
+    def post(self, path, blocking=False):
+        return self.route("POST", path, blocking=blocking)
+
+    def put(self, path, blocking=False):
+        return self.route("PUT", path, blocking=blocking)
+
+    def delete(self, path, blocking=False):
+        return self.route("DELETE", path, blocking=blocking)
+
+    def cache(self, prefix, cachecontrol):
+        """
+        send "Cache-Control: cachecontrol" with GET responses for routes
+        starting with prefix, e.g cache("/files/", "max-age=60").
+        the longest matching prefix wins.
+        """
+        self.cachecontrols[prefix] = cachecontrol
+        # longest first, so the first match is the most specific one
+        self.cacheprefixes = sorted(self.cachecontrols, key=len, reverse=True)
+
+    def cachecontrol(self, route):
+        """Cache-Control header (as a dict) configured for route"""
+        for prefix in self.cacheprefixes:
+            if route.startswith(prefix):
+                return {"Cache-Control": self.cachecontrols[prefix]}
+        return {}
+
+    def fbpath(self, route):
+        """filesystem path for a route under fbroute, None if not one"""
         if self.fbroot == None:  # if fbrowser not enabled, return None immediately
-            return None, None
+            return None
         if not route.startswith(self.fbroute):  # not to be handled by filebrowser
-            return None, None
-        else:
-            self.logger.error(self.fbroot)
-            self.logger.error(self.fbroute)
-            self.logger.error(route)
-            fspath = os.path.join(
-                self.fbroot, route[len(self.fbroute) :]
-            )  # fbroute must end with /
-            self.logger.error(fspath)
+            return None
+        return os.path.join(
+            self.fbroot, route[len(self.fbroute) :]
+        )  # fbroute must end with /
 
-        # HANDLE GET
-        if method == "GET" and os.path.isfile(fspath):
-            # return generator
-            def fread_chunked():
-                with open(fspath, "r") as f:
-                    while chunk := f.read(2048):  # default chunk size of 2048
-                        yield chunk
-
-            return os.path.getsize(fspath), fread_chunked()
-
-        elif method == "GET" and os.path.isdir(fspath):
-            children = os.listdir(fspath)
-            children = [(child, os.path.join(fspath, child)) for child in children]
-            # append forward slash (/) if a directory by using os.path.join("hello","")
-            # to make it "hello/"
-            children = [
-                (
-                    os.path.join(child, "") if os.path.isdir(childpath) else child,
-                    childpath,
-                )
-                for child, childpath in children
+    def servefile(self, req, fspath):
+        """
+        respond with a file, binary safe. ETag and Last-Modified come from
+        os.stat, If-None-Match/If-Modified-Since are answered with 304.
+        a file.gz next to the file is sent instead to clients accepting gzip,
+        else text files are compressed on the fly if enabled.
+        returns statuscode, response, body.
+        """
+        ext = os.path.splitext(fspath)[1].lower()
+        conttype = mimetypes.get(ext, "application/octet-stream")
+        headers, encoding, suffix = {}, None, ""
+        if os.path.isfile(fspath + ".gz"):  # precompressed, as is
+            headers["Vary"] = "Accept-Encoding"
+            if acceptsencoding(req.headers, "gzip"):
+                fspath, suffix = fspath + ".gz", "-gz"
+                headers["Content-Encoding"] = "gzip"
+        st = os.stat(fspath)
+        if (
+            suffix == ""
+            and "Range" not in req.headers
+            and st.st_size >= self.response.compressmin
+            and compressible(conttype)
+            and (encoding := self.encoding(req)) != None
+        ):
+            suffix = "-" + encoding  # a different representation, a different etag
+        mtime = int(st.st_mtime)
+        etag = f'"{mtime:x}-{st.st_size:x}{suffix}"'
+        headers.update(
+            {
+                "Content-Length": st.st_size,
+                "Content-Type": conttype,
+                "ETag": etag,
+                "Last-Modified": httpdate(mtime),
+                "Accept-Ranges": "bytes",
+            }
+        )
+        headers.update(self.cachecontrol(req.route))
+        if encoding != None:  # compressed on the fly, length unknown and no ranges
+            headers["Content-Length"] = headers["Accept-Ranges"] = None
+
+        if notmodified(req.headers, etag, mtime):
+            # no body, Content-Length still tells the size of the file
+            return 304, self.response("", req, statuscode=304, headers=headers), None
+
+        if encoding != None:
+            body = FileBody(fspath, chunksize=self.chunksize)
+            body = self.stream(req, body, headers, encoding)
+            return 200, self.response("", req, statuscode=200, headers=headers), body
+
+        # Range: bytes=..., unless If-Range says the client has another version
+        ranges = None
+        if (rangehdr := req.headers.get("Range")) != None:
+            ifrange = req.headers.get("If-Range")
+            if ifrange == None or ifrange in (etag, headers["Last-Modified"]):
+                ranges = parseranges(rangehdr, st.st_size)
+
+        if ranges == []:  # none of them overlaps the file
+            headers.update(
+                {"Content-Length": 0, "Content-Range": f"bytes */{st.st_size}"}
+            )
+            return 416, self.response("", req, statuscode=416, headers=headers), None
+
+        if ranges != None and len(ranges) == 1:
+            start, end = ranges[0]
+            headers.update(
+                {
+                    "Content-Length": end - start + 1,
+                    "Content-Range": f"bytes {start}-{end}/{st.st_size}",
+                }
+            )
+            body = FileBody(fspath, start, end - start + 1, self.chunksize)
+            return 206, self.response("", req, statuscode=206, headers=headers), body
+
+        if ranges != None:  # multipart/byteranges, each part has its own headers
+            boundary = f"httpico-{etag[1:-1]}"
+            partheads = [
+                f"\r\n--{boundary}\r\nContent-Type: {conttype}\r\n"
+                f"Content-Range: bytes {start}-{end}/{st.st_size}\r\n\r\n".encode()
+                for start, end in ranges
             ]
+            closing = f"\r\n--{boundary}--\r\n".encode()
+
+            def byteranges():
+                for parthead, (start, end) in zip(partheads, ranges):
+                    yield parthead
+                    yield from FileBody(fspath, start, end - start + 1, self.chunksize)
+                yield closing
+
+            headers.update(
+                {
+                    "Content-Length": sum(map(len, partheads))
+                    + sum(end - start + 1 for start, end in ranges)
+                    + len(closing),
+                    "Content-Type": f"multipart/byteranges; boundary={boundary}",
+                }
+            )
+            return (
+                206,
+                self.response("", req, statuscode=206, headers=headers),
+                byteranges(),
+            )
+
+        # binary safe, yields bytes (or is sendfile'd)
+        body = FileBody(fspath, chunksize=self.chunksize)
+        return 200, self.response("", req, statuscode=200, headers=headers), body
+
+    def listdir(self, fspath):
+        """
+        entries (name, isdir, size, mtime) of a directory. the names are
+        cached and reused for as long as the directory mtime is unchanged,
+        sizes and mtimes are read every time: a file written in place does
+        not change the mtime of its directory.
+        """
+        mtime = os.stat(fspath).st_mtime
+        if (cached := self.listings.get(fspath)) != None and cached[0] == mtime:
+            return restat(fspath, cached[1])
+        entries = scandir(fspath)
+        if fspath not in self.listings and len(self.listings) >= self.maxlistings:
+            del self.listings[next(iter(self.listings))]  # drop the oldest
+        self.listings[fspath] = mtime, [(name, isdir) for name, isdir, _, _ in entries]
+        return entries
+
+    def listjson(self, fspath, query):
+        """
+        machine readable page of a directory listing, for sync tools.
+        query: offset, limit, sort (name|mtime|size), order (asc|desc) and
+        since (only entries modified after this unix time).
+        """
+        try:
+            offset = int(query.get("offset", 0))
+            limit = int(query.get("limit", 100))
+            since = float(query.get("since", 0))
+        except ValueError:
+            return 400, {"status": 1, "info": "offset, limit and since must be numbers"}
+        sortkey = query.get("sort", "name")
+        if sortkey not in ("name", "mtime", "size"):
+            return 400, {"status": 1, "info": f"cannot sort by: {sortkey}"}
+
+        entries = self.listdir(fspath)
+        if since:
+            entries = [e for e in entries if e[3] > since]
+        keyidx = {"name": 0, "size": 2, "mtime": 3}[sortkey]
+        entries = sorted(
+            entries, key=lambda e: e[keyidx], reverse=query.get("order") == "desc"
+        )
+        return (
+            200,
+            {
+                "status": 0,
+                "path": fspath,
+                "mtime": os.stat(
+                    fspath
+                ).st_mtime,  # changes when entries are added/removed
+                "total": len(entries),
+                "offset": offset,
+                "limit": limit,
+                "entries": [
+                    {"name": name, "dir": isdir, "size": size, "mtime": mtime}
+                    for name, isdir, size, mtime in entries[offset : offset + limit]
+                ],
+            },
+        )
+
+    def filebrowse(self, route, method):
+        if (fspath := self.fbpath(route)) == None:
+            return None, None
+        elif self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug(
+                f"filebrowse {route} -> {fspath} ({self.fbroot} at {self.fbroute})"
+            )
 
-            # body
-            html = f"""
+        # HANDLE GET
+        if method == "GET" and os.path.isdir(fspath):
+            entries = self.listdir(fspath)
+
+            # head, css/js are in a separate cacheable asset
+            head = f"""
+                    <head>
+                    <link rel="stylesheet" href="{FBASSETS}filebrowser.css">
+                    <script src="{FBASSETS}filebrowser.js"></script>
+                    </head>
                     <body>
                     <h2>HTTPico File Browser</h2>
                     <h3>pwd: <u>{fspath}</u><input type="text" id="newfoldername"></input> &nbsp;&nbsp<button id="createfolder" onclick="mkdir(document.getElementById('newfoldername').value)">Create Folder</button></h3>
@@ -461,7 +2459,7 @@ class HTTPico:
                     </form></br></br>"""
 
             # file table
-            html += f"""<table>
+            head += f"""<table>
                     <thead>
                         <tr>
                             <th>Size</th>
@@ -473,14 +2471,20 @@ class HTTPico:
                     <tr>
                         <td></td>
                         <td></td>
-                        <td> <a style="color:forestgreen" href="{os.path.dirname(route[:-1] if route.endswith("/") else route )}/">..</a> </td>
+                        <td> <a style="color:forestgreen" href="{os.path.dirname(route[:-1] if route.endswith("/") else route)}/">..</a> </td>
                         <td></td>
                     </tr>
+                    <tbody>
                     """
 
-            tablerows = "\n".join(
-                [
-                    """<tr>
+            def render(rowsperchunk=32):
+                # rows are rendered a few at a time while being sent,
+                # the whole page is never held in memory
+                yield head.encode()
+                rows = []
+                for childname, isdir, size, mtime in entries:
+                    rows.append(
+                        """<tr>
                     <td>{filesize}</td>
                     <td>{modtime}</td>
                     <td>
@@ -490,117 +2494,29 @@ class HTTPico:
                         <button onclick="deletefile('{childname}')">delete</button>
                     </td>
                     </tr>""".format(
-                        filesize="---"
-                        if os.path.isdir(childpath)
-                        else os.path.getsize(childpath)
-                        if os.path.getsize(childpath) < 1024
-                        else f"{(os.path.getsize(childpath)/1024):.1f}k",
-                        # childroute=os.path.join(route, childname),
-                        childname=childname,
-                        childpath=childpath,
-                        childcolor="springgreen"
-                        if os.path.isdir(childpath)
-                        else "magenta",
-                        modtime=dtime.fromtimestamp(
-                            os.path.getmtime(childpath)
-                        ).strftime("%d %b %H:%M"),
+                            filesize="---"
+                            if isdir
+                            else size
+                            if size < 1024
+                            else f"{(size / 1024):.1f}k",
+                            # append forward slash (/) if a directory
+                            childname=f"{childname}/" if isdir else childname,
+                            childcolor="springgreen" if isdir else "magenta",
+                            modtime=dtime.fromtimestamp(mtime).strftime("%d %b %H:%M"),
+                        )
                     )
-                    for childname, childpath in children
-                ]
-            )
-
-            html += "<tbody>\n" + tablerows + "\n</tbody>\n</table>"
-
-            # add css
-            html += """
-            <style>
-            body{
-                background: black;
-                font-family: monospace
-            }
-            h2{
-                color: indianred;
-            }
-            h3{
-                color: gold;
-            }
-            table {
-              width: 50%;
-              border-collapse: collapse; /* Remove double borders */
-              text-align: left; /* Align text to the left */
-              /* font-family: monospace;*/ /* Clean font */
-              font-size: 16px; /* Legible size */
-            }
+                    if len(rows) == rowsperchunk:
+                        yield "\n".join(rows).encode()
+                        rows = []
+                rows.append("</tbody>\n</table>\n</body>")
+                yield "\n".join(rows).encode()
 
-            th, td {
-              /*padding: 10px; *//* Equal spacing */
-              /* border: 1px solid #ddd; *//* Light border */
-              color: gray;
-            }
-
-            thead {
-              font-weight: bold;
-              font-style: italic;
-            }
-
-            form label{ "fbrout must end with forward slash(/)"
-                color: deepskyblue;
-                font-weight: bold;
-                font-size: 1.25em;
-                text-decoration: underline;
-                margin-right: 1em;
-            }
-            form input::file-selector-button{
-                background: lightSteelBlue;
-            }
-            form input[type=file]{
-                color: deepskyblue;
-                font-style: italic;
-                font-weight: bold;
-            }
-            form input[type=submit]{
-                background: lightSteelBlue
-            }
-            
-            #createfolder, #newfoldername{
-                border-radius: 1em;
-                background: silver;
-                
-            }
-            </style>
-
-            <script>
-                function deletefile(filename){
-                if(!confirm("Delete file: " + filename + "! Sure?")) return;
-                fetch(url=filename, {method: 'DELETE'}).then(response => response.json()).then(data=>{console.log(data);if(data.status==0)window.location.reload(true)});
-                }
-
-
-                function mkdir(foldername){
-                    if(foldername=="") return;
-                    if(foldername.includes("/") | foldername.includes(".")) {
-                        alert("'/' and '.' cannot be part of the folder name");
-                        return;
-                    }
-                    //confirm("Create new folder? Name: " + foldername )
-                    fetch(url=foldername, {method: "PUT"}).then(response => response.json()).then(data => {console.log(data); if(data.status==0)window.location.reload(true)})
-                }
-            </script>
-            """
-            # return html
-            return len(html), (
-                h for h in [html]
-            )  # mimic filesize, chunked read generator
+            return None, render()  # length not known up front, sent chunked
 
         # path not found - neither a file nor a directory
         elif method == "GET":
             return None, None
 
-        # Handle upload
-        elif method == "POST":
-            self.logger.error(fspath)
-            self.logger.error(req.form)
-
         elif method == "PUT":
             # since the newfoldername(the last part of fspath after /),
             # and as it may contain special characters( as it was input by user),
@@ -632,7 +2548,10 @@ class HTTPico:
 
 
 def fileuploader(filedir, filename, filecontent):
-    if type(filedir) == type(filename) == type(filecontent) == str:
+    if type(filedir) == type(filename) == str and type(filecontent) in [
+        str,
+        UploadedFile,
+    ]:
         pass
     else:
         return None
@@ -642,11 +2561,17 @@ def fileuploader(filedir, filename, filecontent):
         return 400, {"status": 1, "info": f"file:{fspath} already exists !!!"}
     else:
         try:
-            with open(fspath, "w") as g:
-                g.write(filecontent)
+            if type(filecontent) is UploadedFile:
+                # already streamed to disk while it was received, just move it
+                size = filecontent.size
+                filecontent.moveto(fspath)
+            else:
+                size = len(filecontent)
+                with open(fspath, "w") as g:
+                    g.write(filecontent)
             return 201, {
                 "status": 0,
-                "info": f"Succesfully wrote {len(filecontent)} bytes into: {fspath}",
+                "info": f"Succesfully wrote {size} bytes into: {fspath}",
             }
         except Exception as e:
             return 500, {"status": 2, "info": f"Internal Server Exception -> {e}"}
@@ -662,7 +2587,7 @@ if __name__ == "__main__":
 
     app = HTTPico(HOST, PORT, fbroot="templates/", fbroute="files/")
 
-    @app.get("/")
+    @app.get("/", cache_ttl=60, deps=("templates/index.html",))
     def g():
         return open("templates/index.html").read()
 
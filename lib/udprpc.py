@@ -1,9 +1,10 @@
 import socket
 import json
 import select
+import struct
 
 try:
-    from types import FunctionType as FnType
+    from types import FunctionType as FnType, MethodType as BoundMethodType
 except:
     FnType = type(lambda: 1)
 
@@ -13,11 +14,31 @@ except:
 
     BoundMethodType = type(lorem().ipsum)  # type = bound_method
     del lorem  # cleanup
+
+try:
+    from time import ticks_ms, ticks_diff  # micropython
+except ImportError:
+    from time import monotonic
+
+    def ticks_ms():
+        return int(monotonic() * 1000)
+
+    def ticks_diff(a, b):
+        return a - b
+
+
 import logging
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(format="%(name)s:%(message)s", level=logging.INFO)
 
+MAXDATAGRAM = 1472  # udp payload that fits a 1500 byte (ethernet/wifi) MTU
+
+# compact binary calls/replies, see RPC.callbinary
+MAGIC = 0xB7  # first byte of a binary datagram, never starts a JSON text
+MAGICID = 0xB8  # the same, with a 16 bit request id after the first byte
+OK, NOMETHOD, EXCEPTION, BADREQUEST, UNPACKABLE = range(5)  # reply status
+
 
 class RPC:
     def __init__(self, ip="0.0.0.0", port=5001):
@@ -26,13 +47,23 @@ class RPC:
         sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         sock.bind((ip, port))
+        sock.setblocking(False)  # only read once select says so, or while draining
 
         self.sock = sock
         self.functions = {}
+        self.table = []  # functions by method id, i.e the order listall gives
+        self.outbuf = bytearray(MAXDATAGRAM)  # binary replies are packed in here
+        # datagrams are received into this, see handle_many
+        self.inbuf = bytearray(MAXDATAGRAM)
+        self.inview = memoryview(self.inbuf)
+        # (addr, id) -> reply, (addr, ids of a batch) -> its datagrams, for repeats
+        self.replies = {}
+        self.maxreplies = 32  # no. of replies kept for retransmissions
 
     def register(self, func):
         assert type(func) in [FnType, BoundMethodType]
         self.functions[func.__name__] = func
+        self.table = list(self.functions.values())
         logger.info(f"Registered -> {func.__name__}")
         return func
 
@@ -44,7 +75,9 @@ class RPC:
         else:
             return False
         del self.functions[func]
-        logger.info(f"Deregistered -> {func.__name__}")
+        # ids after it shift, clients refetch listall
+        self.table = list(self.functions.values())
+        logger.info(f"Deregistered -> {func}")
         return True
 
     def handle(self, timeout=None):
@@ -57,19 +90,102 @@ class RPC:
 
         if self.sock not in readable:  # if sock is not readable yet, return False
             return False
-        data, addr = self.sock.recvfrom(1024)
         try:
-            payload = json.loads(data)
-            payload["note"] = ""
+            data, addr = self.sock.recvfrom(MAXDATAGRAM)
+        except OSError:  # gone again (e.g a bad checksum), nothing to do
+            return False
+        self.process(data, addr)
+
+    def handle_many(self, timeout=0, budget=20, count=64):
+        """
+        wait up to timeout seconds (select) for a datagram, then serve all
+        pending ones without checking again, until the socket is drained
+        or budget milliseconds or count datagrams are used up.
+        datagrams are received into one preallocated buffer.
+        returns the no. of datagrams served.
+        """
+        readable, writable, exceptional = select.select([self.sock], [], [], timeout)
+        if self.sock not in readable:
+            return 0
+        recvfrom_into = getattr(self.sock, "recvfrom_into", None)  # not on micropython
+        start, served = ticks_ms(), 0
+        while served < count and ticks_diff(ticks_ms(), start) < budget:
+            try:
+                if recvfrom_into != None:
+                    n, addr = recvfrom_into(self.inbuf)
+                    data = self.inview[:n]
+                else:
+                    data, addr = self.sock.recvfrom(MAXDATAGRAM)
+            except OSError:  # EAGAIN, all drained
+                break
+            self.process(data, addr)
+            served += 1
+        return served
+
+    def poll(self):
+        """serve whatever is pending without waiting, for busy app loops"""
+        return self.handle_many(0)
+
+    def process(self, data, addr):
+        """answer a received datagram (bytes or a memoryview of inbuf)"""
+        if data and data[0] in (MAGIC, MAGICID):
+            self.sock.sendto(self.callbinary(data, addr), addr)
+            return
+
+        try:
+            payload = json.loads(bytes(data))
         except:
             payload = {"note": "| invalid JSON format |"}
             self.sock.sendto(json.dumps(payload).encode(), addr)
             return
-        finally:
-            if type(payload) != dict:
-                payload = {"note": "| payload must be a JSON dict |"}
-                self.sock.sendto(json.dumps(payload).encode(), addr)
-                return
+
+        if type(payload) == list:  # a batch of calls, replies in the same order
+            key = self.batchkey(payload, addr)
+            if key in self.replies:  # a retransmission, sent again as it was
+                datagrams = self.replies[key]
+            else:
+                datagrams = self.batch([self.call(p) for p in payload])
+                if key != None:  # kept whole, it can't push out its own replies
+                    datagrams = list(datagrams)
+                    self.remember(key, datagrams)
+            for datagram in datagrams:
+                self.sock.sendto(datagram, addr)
+            return
+
+        # write results back
+        self.sock.sendto(json.dumps(self.call(payload, addr)).encode(), addr)
+
+    def remember(self, key, reply):
+        """keep the reply to a request with an id, for when it is sent again"""
+        if key not in self.replies and len(self.replies) >= self.maxreplies:
+            del self.replies[next(iter(self.replies))]  # drop the oldest
+        self.replies[key] = reply
+
+    def replaykey(self, payload, addr):
+        """(addr, id) of a call which has an id, else None"""
+        callid = payload.get("id")
+        if addr == None or type(callid) not in (int, str):
+            return None
+        return addr, callid
+
+    def batchkey(self, payload, addr):
+        """(addr, ids) of a batch in which every call has an id, else None"""
+        keys = [self.replaykey(p, addr) if type(p) == dict else None for p in payload]
+        if not keys or None in keys:
+            return None
+        return addr, tuple(key[1] for key in keys)
+
+    def call(self, payload, addr=None, remember=True):
+        """
+        run one {"method": ..., "params": [...]} call, returns the reply.
+        a call with an "id" which was answered before (a retransmission
+        from addr) gets the same reply, without running the method again.
+        """
+        if type(payload) != dict:
+            return {"note": "| payload must be a JSON dict |"}
+        if (key := self.replaykey(payload, addr)) != None and key in self.replies:
+            return self.replies[key]
+        payload["note"] = ""
 
         if not "method" in payload:
             payload["note"] += "| missing JSON key 'method' |"
@@ -96,13 +212,110 @@ class RPC:
             try:
                 payload["result"] = self.functions[method](*params)
             except:
-                payload["note"] += f"| Exception calling {method}(*{params}) |"
-                __fn = self.functions[method]
-                if "__doc__" in dir(__fn):
-                    payload["fndoc"] = __fn.__doc__
+                self.failed(payload)
 
-        # write results back
-        self.sock.sendto(json.dumps(payload).encode(), addr)
+        if key != None and remember:
+            self.remember(key, payload)
+        return payload
+
+    def failed(self, payload):
+        """note on the reply that the call raised, with the doc of the method"""
+        method, params = payload["method"], payload.get("params", [])
+        payload["note"] += f"| Exception calling {method}(*{params}) |"
+        __fn = self.functions[method]
+        if "__doc__" in dir(__fn):
+            payload["fndoc"] = __fn.__doc__
+
+    def callbinary(self, data, addr=None):
+        """
+        run a call in the compact binary format, returns the reply.
+        both are a header of 3 bytes: MAGIC, the method id (status in the
+        reply) and the no. of values, then the struct format char of every
+        value (b, h, i, q, B.., f, d) and the values packed big-endian.
+        with MAGICID a 16 bit request id follows the first byte, and is
+        echoed in the reply. repeats of it are answered from the replies
+        kept, as with JSON calls.
+        method ids are the positions in list(rpc.functions), as listall
+        gives them.
+        """
+        if (callid := self.binaryid(data)) == None or addr == None:
+            return self.packreply(*self.runbinary(data), callid)
+        key = addr, MAGICID, callid
+        if key not in self.replies:
+            self.remember(key, bytes(self.packreply(*self.runbinary(data), callid)))
+        return self.replies[key]
+
+    def binaryid(self, data):
+        """request id of a binary call, None if it has none"""
+        if data[0] != MAGICID or len(data) < 3:
+            return None
+        return struct.unpack_from("!H", data, 1)[0]
+
+    def runbinary(self, data):
+        """status, result of a binary call"""
+        head = 3 if data[0] == MAGICID else 1  # where the method id is
+        try:
+            methodid, n = struct.unpack_from("!BB", data, head)
+            fmt = "!" + bytes(data[head + 2 : head + 2 + n]).decode()
+            params = struct.unpack_from(fmt, data, head + 2 + n)
+        except:
+            return BADREQUEST, None
+        if methodid >= len(self.table):
+            return NOMETHOD, None
+        try:
+            return OK, self.table[methodid](*params)
+        except:
+            return EXCEPTION, None
+
+    def packreply(self, status, result=None, callid=None):
+        """binary reply with result (None, a number or a list of numbers)"""
+        if result == None:
+            values = ()
+        elif type(result) in (list, tuple):
+            values = result
+        else:
+            values = (result,)
+        fmt = ""
+        for v in values:
+            if type(v) is bool:
+                fmt += "B"
+            elif type(v) is int:
+                fmt += "i" if -(2**31) <= v < 2**31 else "q"
+            elif type(v) is float:
+                fmt += "d"
+            else:  # strings etc. are left to JSON
+                return self.packreply(UNPACKABLE, None, callid)
+        n = len(fmt)
+        if n > 255:  # the count is a single byte
+            return self.packreply(UNPACKABLE, None, callid)
+        head = 1 if callid == None else 3  # where the status goes
+        size = head + 2 + n + struct.calcsize("!" + fmt)
+        if size > MAXDATAGRAM:
+            return self.packreply(UNPACKABLE, None, callid)
+        buf = self.outbuf
+        if callid == None:
+            buf[0] = MAGIC
+        else:
+            struct.pack_into("!BH", buf, 0, MAGICID, callid)
+        struct.pack_into("!BB", buf, head, status, n)
+        buf[head + 2 : head + 2 + n] = fmt.encode()
+        struct.pack_into("!" + fmt, buf, head + 2 + n, *values)
+        return memoryview(buf)[:size]
+
+    def batch(self, replies):
+        """
+        encode the replies to a batch as JSON arrays, as many per datagram
+        as fit in MAXDATAGRAM (a reply larger than that goes alone)
+        """
+        chunk, size = [], 2  # the brackets
+        for reply in replies:
+            reply = json.dumps(reply)
+            if chunk and size + len(reply) + 1 > MAXDATAGRAM:
+                yield ("[" + ",".join(chunk) + "]").encode()
+                chunk, size = [], 2
+            chunk.append(reply)
+            size += len(reply) + 1  # the comma
+        yield ("[" + ",".join(chunk) + "]").encode()
 
     def close(self):
         self.sock.close()
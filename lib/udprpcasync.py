@@ -0,0 +1,263 @@
+try:
+    import asyncio
+except ImportError:
+    import uasyncio as asyncio
+import json
+import random
+
+from udprpc import RPC, MAGIC, MAGICID, MAXDATAGRAM, OK, EXCEPTION, logger
+
+
+async def _coro():
+    pass
+
+
+_c = _coro()
+CoroType = type(_c)  # generator on micropython
+_c.close()
+del _c
+
+
+class _Protocol(getattr(asyncio, "DatagramProtocol", object)):
+    """hands datagrams from the asyncio loop to an AsyncRPC or AsyncClient"""
+
+    def __init__(self, owner):
+        self.owner = owner
+
+    def datagram_received(self, data, addr):
+        self.owner.received(data, addr)
+
+
+class AsyncRPC(RPC):
+    """
+    RPC served by an asyncio event loop instead of handle() calls. handlers
+    may be async def, every datagram is answered in a task of its own, so
+    a slow handler does not hold up the others. on CPython the socket is a
+    DatagramProtocol endpoint, uasyncio has none, there it is polled.
+
+        rpc = AsyncRPC()
+        @rpc.register
+        async def getadc(): ...
+        asyncio.run(rpc.serve())
+    """
+
+    def __init__(self, ip="0.0.0.0", port=5001, interval=0.005):
+        super().__init__(ip, port)
+        self.interval = interval  # seconds between polls on uasyncio
+        self.transport = None
+        self.tasks = set()  # running calls, referenced until done
+        self.inflight = {}  # (addr, id) -> (event, [reply]) of async calls still running
+
+    async def serve(self):
+        """serve until cancelled"""
+        if hasattr(asyncio, "DatagramProtocol"):
+            loop = asyncio.get_running_loop()
+            self.transport, _ = await loop.create_datagram_endpoint(
+                lambda: _Protocol(self), sock=self.sock
+            )
+            try:
+                await loop.create_future()  # forever
+            finally:
+                # cancel the calls still running, the socket goes with the transport
+                while self.tasks:
+                    for task in self.tasks:
+                        task.cancel()
+                    await asyncio.gather(*self.tasks, return_exceptions=True)
+                self.transport.close()
+                self.transport = None
+        else:
+            while True:
+                while True:  # drain, the socket is non-blocking
+                    try:
+                        data, addr = self.sock.recvfrom(MAXDATAGRAM)
+                    except OSError:
+                        break
+                    self.received(data, addr)
+                await asyncio.sleep(self.interval)
+
+    def received(self, data, addr):
+        task = asyncio.create_task(self.aprocess(data, addr))
+        if hasattr(task, "add_done_callback"):  # not on uasyncio, which keeps its tasks
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    def send(self, data, addr):
+        if self.transport != None:
+            self.transport.sendto(data, addr)
+        else:
+            self.sock.sendto(data, addr)
+
+    async def aprocess(self, data, addr):
+        """answer a datagram like process(), awaiting async handlers"""
+        if data and data[0] in (MAGIC, MAGICID):
+            callid = self.binaryid(data)
+            key = (addr, MAGICID, callid) if callid != None else None
+            if key in self.replies:  # a retransmission
+                self.send(self.replies[key], addr)
+                return
+            if key in self.inflight:  # a retransmission while the call still runs
+                self.send(await self.replay(key), addr)
+                return
+            status, result = self.runbinary(data)
+            if status == OK and type(result) is CoroType:
+                self.running(key)
+                try:
+                    result = await result
+                except:
+                    status, result = EXCEPTION, None
+                finally:
+                    reply = bytes(self.packreply(status, result, callid))
+                    self.done(key, reply)
+            else:
+                reply = self.packreply(status, result, callid)
+            if key != None:
+                self.remember(key, bytes(reply))
+            self.send(reply, addr)
+            return
+
+        try:
+            payload = json.loads(bytes(data))
+        except:
+            self.send(json.dumps({"note": "| invalid JSON format |"}).encode(), addr)
+            return
+
+        if type(payload) == list:  # a batch, its calls run concurrently
+            key = self.batchkey(payload, addr)
+            if key in self.replies:  # a retransmission
+                datagrams = self.replies[key]
+            elif key in self.inflight:  # a retransmission while the batch still runs
+                datagrams = await self.replay(key)
+            else:
+                self.running(key)
+                datagrams = []
+                try:
+                    replies = await asyncio.gather(*[self.acall(p) for p in payload])
+                    datagrams = list(self.batch(replies))
+                finally:
+                    self.done(key, datagrams)
+                if key != None:  # kept whole, like by process()
+                    self.remember(key, datagrams)
+            for datagram in datagrams:
+                self.send(datagram, addr)
+            return
+
+        self.send(json.dumps(await self.acall(payload, addr)).encode(), addr)
+
+    async def acall(self, payload, addr=None):
+        """call(), awaiting the result of an async handler"""
+        key = self.replaykey(payload, addr) if type(payload) == dict else None
+        if key in self.inflight:  # a retransmission while the call still runs
+            return await self.replay(key)
+        reply = self.call(payload, addr, remember=False)
+        if reply is not payload:  # an error, or the kept reply to a retransmission
+            return reply
+        if type(payload.get("result")) is CoroType:
+            self.running(key)
+            try:
+                payload["result"] = await payload["result"]
+            except:
+                del payload["result"]
+                self.failed(payload)
+            finally:
+                self.done(key, payload)
+        if key != None:
+            self.remember(key, payload)  # only once the result is there
+        return payload
+
+    def running(self, key):
+        """an async call with key started, repeats of it wait for its reply"""
+        if key != None:
+            self.inflight[key] = (asyncio.Event(), [])
+
+    def done(self, key, reply):
+        """the async call with key is over, hand its reply to the repeats waiting"""
+        if key in self.inflight:
+            event, replies = self.inflight.pop(key)
+            replies.append(reply)
+            event.set()
+
+    async def replay(self, key):
+        """the reply to the call with key, once it is over"""
+        event, replies = self.inflight[key]
+        await event.wait()
+        return replies[0]
+
+
+class AsyncClient:
+    """
+    many concurrent JSON calls to many RPC servers over one socket (CPython).
+    every call carries an id, replies are matched to the waiting call by it.
+    a call without a reply is sent again (same id, the server answers it
+    from its kept replies) after timeout, 2*timeout, 4*timeout... seconds.
+
+        client = AsyncClient()
+        adcs = await asyncio.gather(*[client.call(pico, "getadc") for pico in picos])
+    """
+
+    def __init__(self, timeout=0.5, retries=4):
+        self.timeout = timeout  # seconds to wait for the first reply
+        self.retries = retries  # resends before giving up
+        self.transport = None
+        self.opening = asyncio.Lock()  # concurrent first calls open one endpoint
+        self.pending = {}  # id -> future of the reply
+        # not where an earlier client on this port was
+        self.nextid = random.getrandbits(30)
+
+    async def open(self):
+        async with self.opening:
+            if self.transport != None:
+                return
+            loop = asyncio.get_running_loop()
+            self.transport, _ = await loop.create_datagram_endpoint(
+                lambda: _Protocol(self), local_addr=("0.0.0.0", 0)
+            )
+
+    async def call(self, addr, method, *params, timeout=None, retries=None):
+        """
+        method(*params) on the server at addr (ip, port), returns the
+        result. raises RuntimeError with the note of a failed call and
+        asyncio.TimeoutError if there was no reply to any of the retries.
+        """
+        if self.transport == None:
+            await self.open()
+        self.nextid += 1
+        callid = self.nextid
+        future = self.pending[callid] = asyncio.get_running_loop().create_future()
+        data = json.dumps(
+            {"method": method, "params": list(params), "id": callid}
+        ).encode()
+        wait = timeout or self.timeout
+        retries = self.retries if retries == None else retries
+        try:
+            for attempt in range(retries + 1):
+                self.transport.sendto(data, addr)
+                try:  # shielded, a timeout must not cancel the future
+                    reply = await asyncio.wait_for(asyncio.shield(future), wait)
+                    break
+                except asyncio.TimeoutError:
+                    if attempt == retries:
+                        raise
+                    wait *= 2  # back off
+        finally:
+            del self.pending[callid]
+        if "result" not in reply:
+            raise RuntimeError(f"{method}: {reply.get('note')}")
+        return reply["result"]
+
+    def received(self, data, addr):
+        try:
+            replies = json.loads(data)
+        except ValueError:
+            logger.info(f"invalid reply from {addr}")
+            return
+        for reply in replies if type(replies) == list else [replies]:
+            if type(reply) != dict:
+                continue
+            future = self.pending.get(reply.get("id"))
+            if future != None and not future.done():
+                future.set_result(reply)
+
+    def close(self):
+        if self.transport != None:
+            self.transport.close()
+            self.transport = None
@@ -1,24 +1,181 @@
 from fire import Fire
-from socket import SOCK_DGRAM, AF_INET, socket
+from socket import SOCK_DGRAM, AF_INET, socket, timeout as SocketTimeout
 from json import dumps, loads
+import struct, random, time
 
+MAXDATAGRAM = 1472  # udp payload that fits a 1500 byte (ethernet/wifi) MTU
 
-def main(host="localhost", port=5001, method="listall", params=[]):
+# compact binary calls, see udprpc.RPC.callbinary
+MAGIC = 0xB7
+MAGICID = 0xB8  # with a 16 bit request id
+STATUS = ["ok", "method not found", "exception", "bad request", "result not packable"]
+
+
+def roundtrip(sock, addr, datagrams, received, timeout=0.5, retries=4):
+    """
+    send datagrams [(data, ids), ...] to addr and pass every reply to
+    received(data), which returns the ids it answers. datagrams with ids
+    still unanswered are sent again after timeout, 2*timeout, 4*timeout...
+    seconds, the server answers repeated ids from its kept replies without
+    running the call twice. raises TimeoutError after the last retry.
+    """
+    pending = {callid for data, ids in datagrams for callid in ids}
+    for attempt in range(retries + 1):
+        for data, ids in datagrams:
+            if pending.intersection(ids):
+                sock.sendto(data, addr)
+        deadline = time.monotonic() + timeout * 2**attempt
+        while pending and (left := deadline - time.monotonic()) > 0:
+            sock.settimeout(left)
+            try:
+                data, server = sock.recvfrom(65536)
+            except SocketTimeout:
+                break
+            pending -= received(data)
+        if not pending:
+            return
+    raise TimeoutError(f"no reply from {addr[0]}:{addr[1]} after {retries + 1} tries")
+
+
+def call(method, params=[], host="localhost", port=5001, timeout=0.5, retries=4):
+    """call method(*params), returns the reply"""
     if type(params) not in [list, tuple]:
         params = [params]  # params must always be a list
+    callid = random.getrandbits(30)  # an id the server has not seen from this addr
+    payload = dumps({"method": method, "params": params, "id": callid})
+
+    replies = []
+
+    def received(data):
+        reply = loads(data)
+        if type(reply) is not dict or reply.get("id") != callid:
+            return set()  # a late reply to something else
+        replies.append(reply)
+        return {callid}
+
+    sock = socket(AF_INET, SOCK_DGRAM)  # open socket
+    try:
+        datagrams = [(payload.encode(), [callid])]
+        roundtrip(sock, (host, port), datagrams, received, timeout, retries)
+    finally:
+        sock.close()  # close socket
+    return replies[0]
+
+
+def batch(calls, host="localhost", port=5001, timeout=0.5, retries=4):
+    """
+    run many calls with a single round trip: calls is [[method, params], ...]
+    they are sent as JSON arrays, as many per datagram as fit the MTU.
+    returns the replies in the order of the calls.
+    """
+    base = random.getrandbits(30)  # ids the server has not seen from this addr
+    payloads = []
+    for i, (method, *params) in enumerate(calls):
+        params = params[0] if params else []
+        if type(params) not in [list, tuple]:
+            params = [params]  # params must always be a list
+        payloads.append(dumps({"method": method, "params": params, "id": base + i}))
+
+    datagrams, chunk, size = [], [], 2  # the brackets
+    for i, payload in enumerate(payloads):
+        if chunk and size + len(payload) + 1 > MAXDATAGRAM:
+            datagrams.append((("[" + ",".join(chunk) + "]").encode(), ids))
+            chunk, size = [], 2
+        if not chunk:
+            ids = []
+        chunk.append(payload)
+        ids.append(base + i)
+        size += len(payload) + 1  # the comma
+    datagrams.append((("[" + ",".join(chunk) + "]").encode(), ids))
 
-    # print(method)
-    # print(params)
+    replies, callids = {}, range(base, base + len(payloads))
 
-    payload = dumps({"method": method, "params": params})
+    def received(data):  # the replies may come in several datagrams
+        answered = set()
+        for reply in loads(data):
+            if type(reply) is dict and reply.get("id") in callids:
+                replies[reply["id"]] = reply
+                answered.add(reply["id"])
+        return answered
 
     sock = socket(AF_INET, SOCK_DGRAM)  # open socket
-    sock.sendto(payload.encode(), (host, port))
-    data, server = sock.recvfrom(1024)
-    data = dumps(loads(data), indent=2)
-    print(data)
+    try:
+        roundtrip(sock, (host, port), datagrams, received, timeout, retries)
+    finally:
+        sock.close()  # close socket
+    return [replies[base + i] for i in range(len(payloads))]
+
+
+def methodids(host="localhost", port=5001, timeout=0.5):
+    """method name -> id for binary calls, the ids are the order listall gives"""
+    names = batch([["listall"]], host, port, timeout)[0]["result"]
+    return {name: i for i, name in enumerate(names)}
+
+
+def binarycall(
+    method, params=[], host="localhost", port=5001, ids=None, timeout=0.5, retries=4
+):
+    """
+    call method with numeric params in the compact binary format. ids is
+    from methodids(), fetched if not given (pass it on to save a round trip).
+    returns None, a number or a list of numbers.
+    """
+    if ids == None:
+        ids = methodids(host, port, timeout)
+    if type(params) not in [list, tuple]:
+        params = [params]
+    fmt = "".join(
+        "d" if type(p) is float else "i" if -(2**31) <= p < 2**31 else "q"
+        for p in params
+    )
+    callid = random.getrandbits(16)
+    data = struct.pack("!BHBB", MAGICID, callid, ids[method], len(fmt)) + fmt.encode()
+    data += struct.pack("!" + fmt, *params)
+
+    replies = []
+
+    def received(data):
+        if len(data) < 5 or struct.unpack_from("!BH", data) != (MAGICID, callid):
+            return set()  # a late reply to something else
+        replies.append(data)
+        return {callid}
+
+    sock = socket(AF_INET, SOCK_DGRAM)
+    try:
+        roundtrip(sock, (host, port), [(data, [callid])], received, timeout, retries)
+    finally:
+        sock.close()
+
+    data = replies[0]
+    status, n = struct.unpack_from("!BB", data, 3)
+    if status != 0:
+        raise RuntimeError(f"{method}: {STATUS[status]}")
+    values = struct.unpack_from("!" + data[5 : 5 + n].decode(), data, 5 + n)
+    return None if n == 0 else values[0] if n == 1 else list(values)
+
 
-    sock.close()  # close socket
+def main(
+    host="localhost",
+    port=5001,
+    method="listall",
+    params=[],
+    calls=None,
+    binary=False,
+    timeout=0.5,
+    retries=4,
+):
+    """
+    call method(*params), or with calls ([[method, params], ...]) all of
+    them at once, e.g --calls='[["setpwm", [20000]], ["getadc"]]'.
+    binary calls a method with numeric params in the compact format.
+    a call without a reply is retried, waiting twice as long every time.
+    """
+    if calls != None:
+        print(dumps(batch(calls, host, port, timeout, retries), indent=2))
+    elif binary:
+        print(binarycall(method, params, host, port, None, timeout, retries))
+    else:
+        print(dumps(call(method, params, host, port, timeout, retries), indent=2))
 
 
 if __name__ == "__main__":